@@ -0,0 +1,468 @@
+"""
+Офлайн-бенчмарк задержек всего хода: WAV -> STT -> память -> LLM -> TTS.
+
+Без микрофона, без Ollama и без звука:
+  - записи bench/fixtures/*.wav (моно, int16, одна частота) проигрываются
+    в STT в реальном времени через stt.open_virtual_input();
+  - /api/generate и /api/chat отвечает локальный фейковый сервер с заданной
+    задержкой первого токена и темпом генерации;
+  - память — временная база Chroma, засеянная синтетическими заметками;
+  - TTS синтезирует как обычно, но PCM уходит в null-sink.
+
+Метрики (мс, p50/p90/p99):
+  stt_endpoint   конец речи в записи -> listen() вернул фразу
+  memory_search  search_memory(text, limit=4)
+  llm_ttft       запрос к /api/chat -> первый токен
+  tts_synth      синтез + pitch одной фразы
+  first_audio    listen() вернул фразу -> первый PCM в sink
+
+В репозитории: bench/fixtures/weather.wav («какая завтра погода», 22 кГц).
+Baseline зависит от машины и моделей (Vosk, Piper, эмбеддер), поэтому
+не коммитится — его записывают на своей машине через --save-baseline.
+
+Запуск из корня репозитория:
+    python -m bench.latency --runs 5
+    python -m bench.latency --save-baseline bench/baseline.json
+    python -m bench.latency --baseline bench/baseline.json   # код 1 при регрессии
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+FIXTURES_GLOB = os.path.join("bench", "fixtures", "*.wav")
+
+# запросы, если STT не гоняем (нет записей или --no-stt)
+QUERIES = [
+    "какая завтра погода",
+    "напомни что я говорил про проект",
+    "как дела у тебя сегодня",
+    "расскажи что нового",
+]
+
+ANSWER = (
+    "Хорошо, сейчас посмотрю. По памяти ты говорил об этом пару дней назад. "
+    "Если нужно, могу напомнить подробнее, просто скажи."
+)
+
+SEED_TOPICS = ["проект", "погода", "музыка", "работа", "игра", "поездка", "книга", "код"]
+
+METRICS = ["stt_endpoint", "memory_search", "llm_ttft", "tts_synth", "first_audio"]
+
+
+# ---------- фейковая Ollama ----------
+
+def _tokens(text: str) -> list[str]:
+    words = text.split(" ")
+    return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+
+def start_fake_ollama(first_token_sec: float, token_sec: float) -> ThreadingHTTPServer:
+    """
+    Локальный сервер /api/generate и /api/chat: NDJSON-стрим с паузой
+    first_token_sec до первого токена (как prompt eval) и token_sec между токенами.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_chunk(self, obj: dict) -> None:
+            line = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            chat = self.path.startswith("/api/chat")
+
+            def piece(text: str, done: bool) -> dict:
+                d = {"model": body.get("model"), "done": done}
+                if chat:
+                    d["message"] = {"role": "assistant", "content": text}
+                else:
+                    d["response"] = text
+                return d
+
+            if body.get("stream") is False:
+                # прогрев / нестримовый запрос
+                data = json.dumps(piece(ANSWER if body.get("prompt") else "", True)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                time.sleep(first_token_sec)
+                toks = _tokens(ANSWER)
+                for i, tok in enumerate(toks):
+                    if i:
+                        time.sleep(token_sec)
+                    self._send_chunk(piece(tok, False))
+                final = piece("", True)
+                final.update({
+                    "prompt_eval_count": 200,
+                    "prompt_eval_duration": int(first_token_sec * 1e9),
+                    "eval_count": len(toks),
+                    "eval_duration": int(token_sec * len(toks) * 1e9),
+                })
+                self._send_chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # клиент отменил стрим
+                pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------- записи ----------
+
+def load_wav(path: str) -> tuple[np.ndarray, int]:
+    """Моно int16 из WAV; стерео сводится в моно."""
+    with wave.open(path, "rb") as w:
+        if w.getsampwidth() != 2:
+            raise ValueError(f"{path}: нужен 16-битный PCM")
+        sr = w.getframerate()
+        pcm = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+        if w.getnchannels() > 1:
+            pcm = pcm.reshape(-1, w.getnchannels()).mean(axis=1).astype(np.int16)
+    return pcm, sr
+
+
+def last_voiced_sample(pcm: np.ndarray, block: int, threshold_db: float) -> int:
+    """Конец последнего блока громче порога VAD — «конец речи» в записи."""
+    from modules.speech_to_text import block_level_db
+
+    end = 0
+    for start in range(0, len(pcm), block):
+        chunk = pcm[start:start + block]
+        if block_level_db(chunk.tobytes()) > threshold_db:
+            end = start + len(chunk)
+    return end
+
+
+def replay(ring, pcm: np.ndarray, sr: int, block: int, tail_sec: float, voice_end: int, marks: dict) -> None:
+    """
+    Пишет запись в кольцо STT блоками в реальном времени, затем тишину
+    tail_sec. В marks["voice_end"] — момент, когда записан конец речи.
+    """
+    data = np.concatenate([pcm, np.zeros(int(sr * tail_sec), dtype=np.int16)])
+    t0 = time.time()
+    for start in range(0, len(data), block):
+        due = t0 + start / sr
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        ring.write(data[start:start + block])
+        if "voice_end" not in marks and start + block >= voice_end:
+            marks["voice_end"] = time.time()
+        if marks.get("stop"):
+            break
+
+
+# ---------- замеры ----------
+
+class Recorder:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {m: [] for m in METRICS}
+        self.enabled = True  # False на прогревочных проходах
+
+    def add(self, metric: str, sec: float) -> None:
+        if self.enabled:
+            self.samples[metric].append(sec * 1000.0)
+
+    def summary(self) -> dict:
+        out = {}
+        for metric, values in self.samples.items():
+            if not values:
+                continue
+            a = np.asarray(values)
+            out[metric] = {
+                "n": int(a.size),
+                "mean": float(a.mean()),
+                "p50": float(np.percentile(a, 50)),
+                "p90": float(np.percentile(a, 90)),
+                "p99": float(np.percentile(a, 99)),
+            }
+        return out
+
+
+def print_summary(summary: dict) -> None:
+    print(f"\n{'metric':<15}{'n':>5}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}  (ms)")
+    for metric in METRICS:
+        s = summary.get(metric)
+        if s is None:
+            print(f"{metric:<15}{'—':>5}")
+            continue
+        print(f"{metric:<15}{s['n']:>5}{s['mean']:>10.1f}{s['p50']:>10.1f}{s['p90']:>10.1f}{s['p99']:>10.1f}")
+
+
+def compare(summary: dict, baseline: dict, tolerance: float, slack_ms: float) -> list[str]:
+    """Регрессии: p50/p90 выросли больше чем на tolerance (и больше slack_ms)."""
+    problems = []
+    for metric, base in baseline.items():
+        cur = summary.get(metric)
+        if cur is None:
+            continue
+        for q in ("p50", "p90"):
+            limit = base[q] * (1.0 + tolerance) + slack_ms
+            if cur[q] > limit:
+                problems.append(f"{metric} {q}: {cur[q]:.1f} ms > {limit:.1f} ms (baseline {base[q]:.1f})")
+    return problems
+
+
+def seed_memory(memory, count: int) -> None:
+    for i in range(count):
+        topic = SEED_TOPICS[i % len(SEED_TOPICS)]
+        memory.save_memory("User", f"заметка {i}: поговорили про {topic}, вариант {i * 7 % 13}")
+    memory.flush_memory()
+
+
+def _patch(saved: list, obj, name: str, value) -> None:
+    """obj.name = value с запоминанием старого значения (см. _restore)."""
+    saved.append((obj, name, getattr(obj, name)))
+    setattr(obj, name, value)
+
+
+def _restore(saved: list) -> None:
+    while saved:
+        obj, name, value = saved.pop()
+        setattr(obj, name, value)
+
+
+def run(args) -> dict:
+    # временная память и никакой записи статистики в рабочие файлы;
+    # всё подменённое возвращается на место в finally
+    tmp = tempfile.mkdtemp(prefix="jarvis-bench-")
+    saved: list = []
+    server = None
+    memory = tts = tracing = None
+    try:
+        # сначала config: модули, импортированные ниже впервые, сразу берут
+        # временные пути — в том числе объекты, чьи atexit-хуки сработают
+        # уже после _restore (эндпоинтер STT)
+        import config
+        for name, value in (
+            ("EMBED_CACHE_PATH", None),
+            ("TRACE_JSONL_PATH", os.path.join(tmp, "trace.jsonl")),
+            ("TRACE_PROM_PATH", os.path.join(tmp, "metrics.prom")),
+            ("STT_ENDPOINT_STATS_PATH", None),
+            ("TTS_CACHE_DIR", None),
+        ):
+            _patch(saved, config, name, value)
+
+        # модули могли быть импортированы раньше — им те же пути напрямую
+        import modules.chroma_memory as memory
+        _patch(saved, memory, "CHROMA_DIR", tmp)
+        _patch(saved, memory, "EMBED_CACHE_PATH", None)
+        import modules.tracing as tracing
+        _patch(saved, tracing, "TRACE_JSONL_PATH", os.path.join(tmp, "trace.jsonl"))
+        _patch(saved, tracing, "TRACE_PROM_PATH", os.path.join(tmp, "metrics.prom"))
+
+        import modules.ollama_client as ollama
+        import modules.text_to_speech as tts
+
+        server = start_fake_ollama(args.first_token_ms / 1000.0, args.token_ms / 1000.0)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        _patch(saved, ollama, "OLLAMA_URL", base_url + "/api/generate")
+        _patch(saved, ollama, "OLLAMA_CHAT_URL", base_url + "/api/chat")
+
+        return _measure(args, memory, ollama, tts, saved)
+    finally:
+        if tts is not None and not args.no_tts:
+            tts.stop_tts()
+            tts.set_sink(None)
+        if server is not None:
+            server.shutdown()
+        if memory is not None:
+            memory.shutdown_memory()
+        if tracing is not None:
+            # спаны бенча — во временный файл, и забыть их: atexit-flush
+            # после _restore писал бы уже в настоящие trace.jsonl/metrics.prom
+            tracing.flush()
+            tracing.reset()
+        _restore(saved)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _measure(args, memory, ollama, tts, saved: list) -> dict:
+    from modules.context import ConversationContext
+    from modules.llm import ask_chat_stream
+    from main import SYSTEM_PROMPT
+
+    rec = Recorder()
+    marks: dict = {}
+
+    # TTS: синтез замеряем обёрткой, звук — в null-sink с отметкой первого PCM
+    if not args.no_tts:
+        # ответ фейковой Ollama одинаковый каждый ход — из кэша PCM он бы не синтезировался
+        _patch(saved, tts, "TTS_CACHE_DIR", None)
+        synth, pitch = tts._synth_pcm, tts._pitch_shift
+
+        def timed_synth(text):
+            t0 = time.perf_counter()
+            pcm = synth(text)
+            marks["synth_t0"] = t0
+            return pcm
+
+        def timed_pitch(pcm, semitones=None):
+            out = pitch(pcm, semitones)
+            rec.add("tts_synth", time.perf_counter() - marks.pop("synth_t0", time.perf_counter()))
+            return out
+
+        def sink(pcm, sample_rate):
+            marks.setdefault("first_audio", time.time())
+            if args.real_time_sink:
+                tts.null_sink(pcm, sample_rate)
+
+        _patch(saved, tts, "_synth_pcm", timed_synth)
+        _patch(saved, tts, "_pitch_shift", timed_pitch)
+        tts.set_sink(sink)
+        tts.warm_up()
+
+    fixtures = [] if args.no_stt else sorted(glob.glob(args.fixtures))
+    stt = None
+    if fixtures:
+        import modules.speech_to_text as stt
+        from config import STT_ENDPOINT_MAX_SEC, STT_VAD_THRESHOLD_DB
+        from modules.endpointer import AdaptiveEndpointer
+        # чистый эндпоинтер: выученные паузы пользователя не влияют на замер
+        # и не перезаписываются статистикой бенча
+        _patch(saved, stt, "_endpointer", AdaptiveEndpointer(stats_path=None))
+        stt.warm_up()
+        clips = [load_wav(p) for p in fixtures]
+        rates = {sr for _, sr in clips}
+        if len(rates) != 1:
+            raise SystemExit(f"записи должны быть одной частоты, а тут {sorted(rates)}")
+        ring = stt.open_virtual_input(rates.pop())
+        block = stt.block_samples()
+    else:
+        print("Bench: STT пропущен (нет записей по маске или --no-stt)")
+
+    memory.warm_up_embedder()
+    memory.warm_up_store()
+    seed_memory(memory, args.seed_docs)
+    ollama.warm_up(background=False)
+
+    conversation = ConversationContext(SYSTEM_PROMPT)
+    items = [(p, clip) for p, clip in zip(fixtures, clips)] if fixtures else [(q, None) for q in QUERIES]
+
+    for n in range(args.warmup + args.runs):
+        rec.enabled = n >= args.warmup
+
+        for name, clip in items:
+            marks.clear()
+            if clip is not None:
+                pcm, sr = clip
+                voice_end = last_voiced_sample(pcm, block, STT_VAD_THRESHOLD_DB)
+                feeder = threading.Thread(
+                    target=replay,
+                    args=(ring, pcm, sr, block, STT_ENDPOINT_MAX_SEC + 1.0, voice_end, marks),
+                    daemon=True,
+                )
+                feeder.start()
+                text = stt.listen(timeout_sec=len(pcm) / sr + STT_ENDPOINT_MAX_SEC + 1.0)
+                t_end = time.time()
+                marks["stop"] = True
+                feeder.join()
+                stt._flush_audio()
+                if not text:
+                    print(f"Bench: {os.path.basename(name)} — фраза не распознана")
+                    continue
+                rec.add("stt_endpoint", max(0.0, t_end - marks.get("voice_end", t_end)))
+            else:
+                text = name
+                t_end = time.time()
+
+            t0 = time.perf_counter()
+            relevant = memory.search_memory(text, limit=4)
+            rec.add("memory_search", time.perf_counter() - t0)
+
+            messages = conversation.build(text, relevant)
+
+            def stream():
+                t_req = time.perf_counter()
+                first = True
+                for tok in ask_chat_stream(messages):
+                    if first:
+                        rec.add("llm_ttft", time.perf_counter() - t_req)
+                        first = False
+                    yield tok
+
+            if args.no_tts:
+                answer = "".join(stream())
+            else:
+                answer = tts.speak_stream(stream())
+                tts.wait_idle()
+                if "first_audio" in marks:
+                    rec.add("first_audio", marks["first_audio"] - t_end)
+
+            conversation.add_turn("user", text)
+            conversation.add_turn("assistant", answer)
+
+    return rec.summary()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Офлайн-бенчмарк задержек Jarvis")
+    ap.add_argument("--fixtures", default=FIXTURES_GLOB, help="маска WAV-записей")
+    ap.add_argument("--runs", type=int, default=3, help="проходов по всем записям")
+    ap.add_argument("--warmup", type=int, default=1, help="проходов без замеров")
+    ap.add_argument("--seed-docs", type=int, default=300, help="заметок во временной памяти")
+    ap.add_argument("--first-token-ms", type=float, default=150.0, help="фейковая Ollama: задержка первого токена")
+    ap.add_argument("--token-ms", type=float, default=30.0, help="фейковая Ollama: пауза между токенами")
+    ap.add_argument("--no-stt", action="store_true", help="не гонять STT, брать готовые запросы")
+    ap.add_argument("--no-tts", action="store_true", help="не синтезировать речь")
+    ap.add_argument("--real-time-sink", action="store_true", help="null-sink ждёт длительность фразы, как динамики")
+    ap.add_argument("--output", help="сохранить сводку в JSON")
+    ap.add_argument("--save-baseline", help="записать сводку как baseline")
+    ap.add_argument("--baseline", help="сравнить с baseline, код 1 при регрессии")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p50/p90 (доля)")
+    ap.add_argument("--slack-ms", type=float, default=5.0, help="абсолютный допуск для мелких метрик")
+    args = ap.parse_args(argv)
+
+    summary = run(args)
+    print_summary(summary)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            print(f"Bench: сводка записана в {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(summary, baseline, args.tolerance, args.slack_ms)
+        if problems:
+            print("\nРегрессии:")
+            for p in problems:
+                print("  " + p)
+            return 1
+        print("\nРегрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
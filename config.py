@@ -1,18 +1,125 @@
 OLLAMA_URL = "http://localhost:11434/api/generate"
+OLLAMA_CHAT_URL = "http://localhost:11434/api/chat"
 
 # Проверь через: ollama list
 LLM_MODEL = "mistral"
 VISION_MODEL = "llava"
 
-FFMPEG_PATH = r"C:\Users\sepp3\OneDrive\Desktop\Project\ffmpeg\bin\ffmpeg.exe"
-PITCH_SEMITONES = 3
+# сколько Ollama держит модель в памяти после запроса ("30m", "1h", -1 = всегда)
+OLLAMA_KEEP_ALIVE = "30m"
+# генерировать ответ по стабильному partial, пока ждём конца фразы
+LLM_SPECULATIVE = True
+# прогрев при старте, чтобы первый вопрос не ждал загрузки модели
+OLLAMA_WARMUP_MODELS = [LLM_MODEL, VISION_MODEL]
+# options для каждого запроса; None = значение по умолчанию Ollama
+OLLAMA_OPTIONS = {
+    "num_ctx": 4096,       # бюджет промпта+ответа; по нему же собирается контекст
+    "num_thread": None,
+    "num_predict": 400,    # потолок длины ответа (резерв в num_ctx)
+}
+
+# сборка контекста диалога
+LLM_TOKENIZER_PATH = None     # tokenizer.json модели; None = оценка по символам
+LLM_CHARS_PER_TOKEN = 2.5     # оценка без токенайзера (кириллица дробится сильнее латиницы)
+CONTEXT_MAX_TURNS = 6         # сколько последних ходов (вопрос+ответ) держать в памяти
+# шаблон mistral в Ollama рисует system внутри ПОСЛЕДНЕГО [INST] — он пересчитывается
+# каждый ход. True = system-промпт первой парой user/assistant: префикс не меняется.
+# False — для моделей, чей шаблон ставит system в начало (llama3, qwen...)
+CONTEXT_SYSTEM_AS_TURN = True
+CONTEXT_MEMORY_MAX_TOKENS = 120   # одно воспоминание длиннее — обрезается
+
+# захват экрана для vision
+VISION_CAPTURE = "monitor"    # "monitor" | "window" (активное окно, Windows) | "region"
+VISION_REGION = None          # (left, top, width, height) для "region"
+VISION_MAX_SIDE = 672         # под вход llava; больше модель всё равно не увидит
+VISION_IMAGE_FORMAT = "JPEG"  # "JPEG" | "PNG"
+VISION_JPEG_QUALITY = 85
+VISION_DEBUG = True           # печатать время по стадиям захвата
+
+PITCH_SEMITONES = 2.5   # сдвиг тона голоса TTS (входит в ключ кэша PCM)
 
 VOSK_MODEL_PATH = "models/vosk/vosk-model-small-ru-0.22"
 STT_DEVICE_INDEX = 1   # <-- поставь индекс микрофона из mic_test.py (например 3)
-STT_SAMPLE_RATE = None    # None = взять default_samplerate устройства (рекомендую)
+STT_SAMPLE_RATE = None    # None = 16 кГц, если устройство умеет, иначе его default_samplerate
+STT_MODEL_RATE = 16000    # родная частота модели Vosk; всё остальное ресемплится до неё
 STT_BLOCK_SEC = 0.2
-STT_SILENCE_TIMEOUT = 1.2
+STT_RING_SEC = 10         # размер кольцевого буфера микрофона; старое сверх этого теряется
+STT_SILENCE_TIMEOUT = 1.2      # пауза конца фразы, пока эндпоинтер не набрал статистику
+STT_ENDPOINT_MIN_SEC = 0.4     # для явно законченных фраз ("выход", "да")
+STT_ENDPOINT_MAX_SEC = 2.0     # для обрыва на "и", "ну", "потому что"...
+STT_ENDPOINT_STABLE_BLOCKS = 2 # partial не менялся столько блоков — ждём меньше
+STT_PREMATURE_WINDOW_SEC = 1.0 # речь в это окно после конца фразы = обрезали рано
+STT_SPECULATE_STABLE_SEC = 0.4 # partial стабилен столько — начинаем готовить ответ заранее
+STT_ENDPOINT_STATS_PATH = "memory/endpointer.json"   # None = не сохранять статистику пауз
 STT_MIN_CHARS = 2
 STT_DEBUG = True
 STT_MIN_WORDS = 2
-STT_MAX_UTTERANCE_SEC = 12
\ No newline at end of file
+# команды выхода: короткие, поэтому проходят мимо STT_MIN_WORDS
+EXIT_WORDS = ["выход", "стоп", "закройся"]
+STT_MAX_UTTERANCE_SEC = 12
+
+# VAD перед Vosk: тишина не декодируется
+STT_VAD_ENABLED = True
+STT_VAD_THRESHOLD_DB = -50     # абсолютный минимум уровня речи, dBFS
+STT_VAD_MARGIN_DB = 10         # насколько речь должна быть громче фона
+STT_VAD_HANGOVER_BLOCKS = 3    # сколько блоков после речи ещё отдавать Vosk
+STT_VAD_PREROLL_BLOCKS = 1     # сколько блоков до речи подклеить к началу
+STT_VAD_NOISE_WINDOW_SEC = 5   # окно минимум-статистики: фон = минимум уровня за это время
+STT_VAD_NOISE_RISE = 0.02      # скорость подъёма оценки фона к этому минимуму (за блок)
+
+# barge-in: пока говорит TTS, микрофон слушается; речь пользователя обрывает ответ
+STT_BARGE_IN = True
+STT_BARGE_IN_FRAME_SEC = 0.05     # во время TTS уровень меряется мелкими кадрами
+STT_BARGE_IN_MIN_FRAMES = 3       # столько кадров подряд выше порога = перебили (~150 мс)
+STT_BARGE_IN_MARGIN_DB = 12       # насколько голос должен быть громче ожидаемого эха
+STT_BARGE_IN_COUPLING_DB = -6     # стартовая оценка эха: уровень TTS + это (дальше учится)
+STT_BARGE_IN_PREROLL_SEC = 0.5    # сколько звука до срабатывания отдать Vosk
+
+# стриминг ответа в TTS: длинные фразы без точки режем по запятой после N символов
+TTS_STREAM_CLAUSE_CHARS = 60
+# сколько готовых фраз может ждать воспроизведения (синтез идёт на шаг впереди)
+TTS_AUDIO_BUFFER = 2
+# кэш готового PCM на диске для повторяющихся фраз (приветствие, ошибки, "хорошо")
+TTS_CACHE_DIR = "memory/tts_cache"   # None = без кэша
+TTS_CACHE_MAX_MB = 64
+TTS_CACHE_MAX_CHARS = 120            # длинные ответы почти не повторяются — не кэшируем
+
+# эмбеддинги памяти: "auto" = ONNX (вариант под CPU) с откатом на torch, "onnx", "torch"
+EMBED_BACKEND = "auto"
+EMBED_ONNX_MODEL = None   # None = выбрать по CPU, иначе имя файла из models/all-MiniLM-L6-v2/onnx
+# LRU-кэш эмбеддингов (повторяющиеся фразы и idle-запрос не пересчитываются)
+EMBED_CACHE_SIZE = 2048
+EMBED_CACHE_PATH = "memory/embed_cache.npz"   # None = только в памяти
+
+# запись памяти в фоне: пачка собирается до N сек / N документов, очередь ограничена
+MEMORY_WRITE_BATCH_SEC = 0.5
+MEMORY_WRITE_BATCH_MAX = 32
+MEMORY_WRITE_BACKLOG = 256
+
+# поиск по памяти: кандидатов берём с запасом, потом переранжируем
+MEMORY_MAX_DISTANCE = 0.45        # косинусное расстояние, дальше — не воспоминание
+MEMORY_OVERFETCH = 4              # кандидатов = limit * N
+MEMORY_RECENCY_HALF_LIFE_DAYS = 30
+MEMORY_RECENCY_WEIGHT = 0.2       # доля давности в итоговой оценке
+MEMORY_MMR_LAMBDA = 0.5           # 1 = только релевантность, меньше = больше разнообразия
+
+# компакция памяти: старые реплики сворачиваются в summary по дням, лишнее уходит в архив
+MEMORY_SUMMARIZE_AFTER_DAYS = 3
+MEMORY_TTL_DAYS = 365          # None = хранить вечно
+MEMORY_MAX_DOCS = 5000         # потолок живой коллекции
+MEMORY_ARCHIVE_PATH = "memory/archive.jsonl"   # None = удалять без архива
+MEMORY_REBUILD_RATIO = 0.3     # пересобрать индекс, когда удалено >= 30% от живых
+MEMORY_COMPACT_INTERVAL_SEC = 6 * 3600
+# свёртка дня — вызов той же Ollama, что отвечает в разговоре: за проход не больше
+# N дней (остальные — в следующих проходах) и только после N секунд без ходов
+MEMORY_SUMMARIZE_MAX_DAYS = 2
+MEMORY_COMPACT_QUIET_SEC = 30
+
+# трассировка стадий хода: гистограммы задержек, JSONL со спанами и файл для Prometheus
+TRACE_ENABLED = True           # можно переключать на лету: tracing.set_enabled()
+TRACE_JSONL_PATH = "memory/trace.jsonl"       # None = не писать спаны
+TRACE_JSONL_MAX_BYTES = 5 * 1024 * 1024
+TRACE_JSONL_BACKUPS = 3        # trace.jsonl.1 ... trace.jsonl.N
+TRACE_PROM_PATH = "memory/metrics.prom"       # None = не экспортировать
+TRACE_EXPORT_INTERVAL_SEC = 10
+TRACE_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
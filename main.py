@@ -1,11 +1,15 @@
-import time
-import random
-
-from modules.speech_to_text import listen
-from modules.llm import ask_llm
-from modules.vision import ask_vision
-from modules.chroma_memory import save_memory, search_memory
+import asyncio
+
+from modules.startup import warm_up_parallel
+from modules.context import ConversationContext
+from modules.memory_compaction import start_compaction
+from modules.orchestrator import Orchestrator
+from config import EXIT_WORDS
+import modules.chroma_memory as memory
+import modules.ollama_client as ollama
+import modules.speech_to_text as stt
 import modules.text_to_speech as tts
+from modules import tracing
 
 
 SYSTEM_PROMPT = """
@@ -36,95 +40,52 @@ SYSTEM_PROMPT = """
 IDLE_MIN_SEC = 60
 IDLE_MAX_SEC = 110
 
-def build_prompt(user_text: str, context: str) -> str:
-    return (
-        SYSTEM_PROMPT.strip()
-        + "\n\n"
-        + "Релевантные воспоминания из прошлых разговоров:\n"
-        + (context or "(нет)\n")
-        + "\n"
-        + f"Пользователь: {user_text}\n"
-        + "Ответ:"
-    )
+# Статичный system-промпт стоит в неизменном начале промпта (для mistral —
+# первой парой реплик, см. CONTEXT_SYSTEM_AS_TURN), дальше — последние ходы
+# и воспоминания под бюджет num_ctx. Сколько токенов Ollama реально
+# пересчитала, видно в ollama.prompt_eval_report().
+conversation = ConversationContext(SYSTEM_PROMPT)
+
+
+VISION_WORDS = ["экран", "видишь", "покажи"]
+
+
+def is_vision_request(text: str) -> bool:
+    return any(word in text.lower() for word in VISION_WORDS)
 
-def build_idle_prompt(context: str) -> str:
-    return (
-        SYSTEM_PROMPT.strip()
-        + "\n\n"
-        + "Ситуация: пользователь молчит уже некоторое время.\n"
-        + "Твоя задача — мягко и ненавязчиво начать разговор.\n"
-        + "Скажи одну короткую фразу (1–2 предложения) и задай один вопрос.\n"
-        + "Не будь навязчивым.\n\n"
-        + "Релевантные воспоминания:\n"
-        + (context or "(нет)\n")
-        + "\n"
-        + "Фраза ассистента:"
-    )
 
 def main():
+    # всё тяжёлое грузится параллельно, пока звучит приветствие;
+    # Ollama догружает модели в фоне и не задерживает первый listen()
     tts.speak("Постоянный режим активирован")
-
-    last_user_time = time.time()
-    next_idle_at = last_user_time + random.uniform(IDLE_MIN_SEC, IDLE_MAX_SEC)
-
-    while True:
-        text = (listen() or "").strip()
-
-        # если ничего не распознали — проверяем idle-таймер
-        if not text:
-            now = time.time()
-            if (not tts.is_speaking) and (now >= next_idle_at):
-                try:
-                    context_list = search_memory("последняя тема разговора интересы предпочтения", limit=6)
-                    context = "\n".join(context_list) if context_list else ""
-                except Exception:
-                    context = ""
-
-                idle_answer = ask_llm(build_idle_prompt(context)).strip()
-                if idle_answer:
-                    print("Jarvis (idle):", idle_answer)
-                    tts.speak(idle_answer)
-
-                # планируем следующий “пинг” позже
-                now = time.time()
-                next_idle_at = now + random.uniform(IDLE_MIN_SEC, IDLE_MAX_SEC)
-            continue
-
-        # получили речь пользователя
-        last_user_time = time.time()
-        next_idle_at = last_user_time + random.uniform(IDLE_MIN_SEC, IDLE_MAX_SEC)
-
-        print("You:", text)
-
-        if text.lower() in ["выход", "стоп", "закройся"]:
-            tts.speak("Выключаюсь")
-            break
-
-        # память
-        try:
-            relevant = search_memory(text, limit=6)
-            context = "\n".join(relevant) if relevant else ""
-        except Exception:
-            context = ""
-
-        # vision по ключевым словам
-        if any(word in text.lower() for word in ["экран", "видишь", "покажи"]):
-            answer = (ask_vision(text) or "").strip()
-        else:
-            answer = (ask_llm(build_prompt(text, context)) or "").strip()
-
-        if not answer:
-            answer = "Я не получил ответ. Проверь, запущена ли Ollama и правильна ли модель."
-
-        # сохраняем в память
-        try:
-            save_memory("User", text)
-            save_memory("Assistant", answer)
-        except Exception:
-            pass
-
-        print("Jarvis:", answer)
-        tts.speak(answer)
+    warm_up_parallel(
+        {
+            "tts": tts.warm_up,
+            "vosk": stt.warm_up,
+            "embedder": memory.warm_up_embedder,
+            "chroma": memory.warm_up_store,
+            "ollama": lambda: ollama.warm_up(background=False),
+        },
+        wait_for=["tts", "vosk", "embedder", "chroma"],
+    )
+    orchestrator = Orchestrator(
+        conversation,
+        exit_words=EXIT_WORDS,
+        is_vision=is_vision_request,
+        idle_interval=(IDLE_MIN_SEC, IDLE_MAX_SEC),
+    )
+    # свёртка памяти ходит в ту же Ollama — только пока разговор стоит
+    start_compaction(is_busy=orchestrator.busy)
+    try:
+        asyncio.run(orchestrator.run())
+        # договариваем прощание
+        tts.wait_idle()
+    finally:
+        # итоговые счётчики сессии (эндпоинтер, VAD, кэши, спекуляция) —
+        # для подстройки порогов; они же идут в metrics.prom
+        print("Stats:", tracing.gauges())
+        # потоки TTS не демоны: без этого упавший run() повесил бы процесс
+        tts.stop_tts()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+import threading
+
+import numpy as np
+
+
+class PcmRingBuffer:
+    """
+    Кольцевой буфер int16 PCM фиксированного размера.
+    Память выделяется один раз; writer (аудио-колбэк) только копирует сэмплы
+    в готовый массив. При переполнении теряются самые старые сэмплы —
+    это считается в dropped/overflows. flush() — O(1).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = int(capacity)
+        self._buf = np.zeros(self.capacity, dtype=np.int16)
+        self._written = 0  # всего записано сэмплов (монотонно)
+        self._read = 0     # всего прочитано/выброшено
+        self._cond = threading.Condition()
+
+        self.dropped = 0
+        self.overflows = 0
+
+    def write(self, data) -> None:
+        x = np.frombuffer(data, dtype=np.int16)
+        n = len(x)
+        cap = self.capacity
+
+        with self._cond:
+            if n > cap:
+                self.dropped += n - cap
+                x = x[-cap:]
+                n = cap
+
+            free = cap - (self._written - self._read)
+            if n > free:
+                # читатель не успевает — выкидываем самое старое
+                self._read += n - free
+                self.dropped += n - free
+                self.overflows += 1
+
+            start = self._written % cap
+            first = min(n, cap - start)
+            self._buf[start:start + first] = x[:first]
+            if first < n:
+                self._buf[:n - first] = x[first:]
+
+            self._written += n
+            self._cond.notify_all()
+
+    def available(self) -> int:
+        with self._cond:
+            return self._written - self._read
+
+    def wait(self, n: int, timeout: float | None = None) -> bool:
+        """Ждёт, пока накопится хотя бы n сэмплов. False — таймаут."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._written - self._read >= n, timeout)
+
+    def read(self, n: int) -> np.ndarray:
+        """
+        Забирает до n сэмплов. Если кусок не переходит через конец кольца —
+        это view без копирования (использовать сразу, до следующего круга записи),
+        иначе — склейка двух частей.
+        """
+        with self._cond:
+            n = min(n, self._written - self._read)
+            start = self._read % self.capacity
+            self._read += n
+
+            if start + n <= self.capacity:
+                return self._buf[start:start + n]
+            first = self.capacity - start
+            return np.concatenate((self._buf[start:], self._buf[:n - first]))
+
+    def flush(self) -> None:
+        with self._cond:
+            self._read = self._written
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "buffered": self._written - self._read,
+                "dropped": self.dropped,
+                "overflows": self.overflows,
+            }
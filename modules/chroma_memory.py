@@ -1,74 +1,479 @@
+import atexit
+import hashlib
 import os
+import queue
+import threading
+import time
 from datetime import datetime
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+import numpy as np
+from config import (
+    EMBED_CACHE_SIZE,
+    EMBED_CACHE_PATH,
+    MEMORY_WRITE_BATCH_SEC,
+    MEMORY_WRITE_BATCH_MAX,
+    MEMORY_WRITE_BACKLOG,
+    MEMORY_MAX_DISTANCE,
+    MEMORY_OVERFETCH,
+    MEMORY_RECENCY_HALF_LIFE_DAYS,
+    MEMORY_RECENCY_WEIGHT,
+    MEMORY_MMR_LAMBDA,
+)
+from modules import tracing
+from modules.embedder import load_embedder, normalize_text, EmbeddingCache
 
 CHROMA_DIR = os.path.join("memory", "chroma")
 os.makedirs(CHROMA_DIR, exist_ok=True)
 
-_LOCAL_EMBED_PATH = os.path.join("models", "all-MiniLM-L6-v2")
-_embedder = SentenceTransformer(_LOCAL_EMBED_PATH, local_files_only=True)
+# Тяжёлое (эмбеддер, torch/onnxruntime, chromadb) грузится лениво при первом
+# обращении или заранее через warm_up_embedder()/warm_up_store()
+_embedder = None
+_embed_cache = None
+_embedder_lock = threading.Lock()
 
-_client = chromadb.PersistentClient(
-    path=CHROMA_DIR,
-    settings=Settings(anonymized_telemetry=False),
-)
+_client = None
+_collection = None
+_store_lock = threading.Lock()
+# запись в коллекцию и её пересборка (memory_compaction) не должны пересекаться
+write_lock = threading.Lock()
+# чтение и подмена коллекции при пересборке: поиск не попадёт в переименованную/удалённую
+_swap_lock = threading.Lock()
+
+COLLECTION_NAME = "jarvis_memory"
+_REBUILD_NAME = COLLECTION_NAME + "_rebuild"
+_OLD_NAME = COLLECTION_NAME + "_old"
+
+
+def _get_embedder():
+    global _embedder, _embed_cache
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                embedder = load_embedder()
+                _embed_cache = EmbeddingCache(embedder.model_id, EMBED_CACHE_SIZE, EMBED_CACHE_PATH)
+                _embedder = embedder
+    return _embedder
+
+
+def _get_collection():
+    global _client, _collection
+    if _collection is None:
+        with _store_lock:
+            if _collection is None:
+                import chromadb
+                from chromadb.config import Settings
+
+                _client = chromadb.PersistentClient(
+                    path=CHROMA_DIR,
+                    settings=Settings(anonymized_telemetry=False),
+                )
+                _recover_swap(_client)
+                _collection = _client.get_or_create_collection(
+                    name=COLLECTION_NAME,
+                    metadata={"hnsw:space": "cosine"},
+                )
+    return _collection
+
+
+def _collection_names(client) -> set[str]:
+    # chromadb < 0.6 отдаёт объекты коллекций, новее — имена
+    return {getattr(c, "name", c) for c in client.list_collections()}
+
+
+def _recover_swap(client) -> None:
+    """Процесс упал посреди пересборки: возвращаем старую коллекцию или добиваем мусор."""
+    names = _collection_names(client)
+    if _OLD_NAME in names:
+        if COLLECTION_NAME in names:
+            # новая уже на месте и проверена до переименования — старая не нужна
+            client.delete_collection(_OLD_NAME)
+        else:
+            client.get_collection(_OLD_NAME).modify(name=COLLECTION_NAME)
+            print("Memory: пересборка не завершилась, вернул старую коллекцию")
+    if _REBUILD_NAME in names:
+        client.delete_collection(_REBUILD_NAME)
+
+
+def rebuild_collection() -> int:
+    """
+    HNSW в Chroma не освобождает место от удалённых векторов — переливает
+    живые документы в новую коллекцию и подменяет ею старую. Старая удаляется
+    только после того, как новая переименована и в ней столько же документов;
+    на любой ошибке рабочей остаётся старая. Возвращает число документов.
+    """
+    global _collection
+    with write_lock:
+        old = _get_collection()
+        client = _client
+        data = old.get(include=["documents", "metadatas", "embeddings"])
+        ids = data.get("ids") or []
+
+        if _REBUILD_NAME in _collection_names(client):
+            client.delete_collection(_REBUILD_NAME)
+        new = client.create_collection(name=_REBUILD_NAME, metadata={"hnsw:space": "cosine"})
+        try:
+            for i in range(0, len(ids), 500):
+                new.add(
+                    ids=ids[i:i + 500],
+                    documents=data["documents"][i:i + 500],
+                    metadatas=data["metadatas"][i:i + 500],
+                    embeddings=data["embeddings"][i:i + 500],
+                )
+            if new.count() != len(ids):
+                raise RuntimeError(f"rebuild copied {new.count()} of {len(ids)} documents")
+        except Exception:
+            client.delete_collection(_REBUILD_NAME)
+            raise
+
+        # подмена: поиск ждёт на _swap_lock и видит либо старую, либо новую
+        with _swap_lock:
+            old.modify(name=_OLD_NAME)
+            try:
+                new.modify(name=COLLECTION_NAME)
+                swapped = client.get_collection(COLLECTION_NAME)
+                if swapped.count() != len(ids):
+                    raise RuntimeError("rebuilt collection failed verification")
+            except Exception:
+                # откат: старая снова рабочая, новая — в мусор
+                names = _collection_names(client)
+                if COLLECTION_NAME in names:
+                    client.get_collection(COLLECTION_NAME).modify(name=_REBUILD_NAME)
+                old.modify(name=COLLECTION_NAME)
+                client.delete_collection(_REBUILD_NAME)
+                raise
+            _collection = swapped
+
+        client.delete_collection(_OLD_NAME)
+        return len(ids)
+
+
+def warm_up_embedder() -> None:
+    # прогоняем одну строку, чтобы onnxruntime/torch выделил буферы заранее
+    _get_embedder().encode(["прогрев"])
+
+
+def warm_up_store() -> None:
+    _get_collection().count()
+    backfill_epochs()
+
+
+def backfill_epochs() -> int:
+    """
+    Старые документы хранили время только ISO-строкой — дописываем числовой
+    "epoch", иначе их не видно в фильтрах по времени.
+    """
+    collection = _get_collection()
+    data = collection.get(include=["metadatas"])
+
+    ids, metas = [], []
+    for uid, meta in zip(data.get("ids") or [], data.get("metadatas") or []):
+        meta = dict(meta or {})
+        if "epoch" in meta:
+            continue
+        try:
+            meta["epoch"] = int(datetime.fromisoformat(meta.get("timestamp", "")).timestamp())
+        except ValueError:
+            continue
+        ids.append(uid)
+        metas.append(meta)
+
+    if ids:
+        with write_lock:
+            collection.update(ids=ids, metadatas=metas)
+        print(f"Memory: добавлен epoch в {len(ids)} документов")
+    return len(ids)
 
-_collection = _client.get_or_create_collection(
-    name="jarvis_memory",
-    metadata={"hnsw:space": "cosine"},
-)
 
 def _embed(text: str):
-    return _embedder.encode(
-        text,
-        normalize_embeddings=True
-    ).tolist()
+    embedder = _get_embedder()
+    vec = _embed_cache.get(text)
+    if vec is None:
+        vec = embedder.encode([text])[0]
+        _embed_cache.put(text, vec)
+    return vec.tolist()
 
-def save_memory(role: str, content: str):
 
-    ts = datetime.now().isoformat(timespec="seconds")
-    doc = f"{role}: {content}"
+def embed_cache_stats() -> dict:
+    if _embed_cache is None:
+        return {"size": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+    return _embed_cache.stats()
+
+
+tracing.register_gauges("embed_cache", embed_cache_stats)
 
-    uid = f"{ts}-{abs(hash(doc))}"
+
+def _embed_many(texts: list[str]) -> list[list[float]]:
+    """
+    Эмбеддинги для батча: из кэша что есть, остальное — одним encode.
+    """
+    embedder = _get_embedder()
+    vecs = [_embed_cache.get(t) for t in texts]
+    missing = [i for i, v in enumerate(vecs) if v is None]
+
+    if missing:
+        encoded = embedder.encode([texts[i] for i in missing])
+        for i, vec in zip(missing, encoded):
+            _embed_cache.put(texts[i], vec)
+            vecs[i] = vec
+
+    return [v.tolist() for v in vecs]
+
+
+# write-behind: save_memory только кладёт документ в очередь,
+# фоновый поток пишет пачками (один encode + один add на пачку)
+_write_q: "queue.Queue[tuple[str, str, str] | None]" = queue.Queue(maxsize=MEMORY_WRITE_BACKLOG)
+
+
+def doc_id(doc: str) -> str:
+    """
+    Стабильный id по содержимому ("Role: текст" после нормализации).
+    Одинаковые реплики получают один id — вектор не дублируется.
+    """
+    return "mem-" + hashlib.blake2b(normalize_text(doc).encode("utf-8"), digest_size=16).hexdigest()
+
+
+@tracing.traced("memory.commit")
+def _commit(batch: list[tuple[str, str, str]]) -> None:
+    # дубли внутри пачки схлопываем сразу
+    grouped: dict[str, dict] = {}
+    for role, ts, doc in batch:
+        uid = doc_id(doc)
+        entry = grouped.get(uid)
+        if entry is None:
+            grouped[uid] = {"role": role, "ts": ts, "doc": doc, "n": 1}
+        else:
+            entry["ts"] = ts
+            entry["n"] += 1
 
     try:
-        _collection.add(
-            ids=[uid],
-            documents=[doc],
-            metadatas=[{"role": role, "timestamp": ts}],
-            embeddings=[_embed(doc)],
-        )
+        # эмбеддинги (медленно) — заранее и вне write_lock: считаем для всех,
+        # кого сейчас нет в базе, под локом они достанутся из кэша
+        ids = list(grouped)
+        known = set(_get_collection().get(ids=ids, include=["metadatas"]).get("ids") or [])
+        fresh = [grouped[uid]["doc"] for uid in ids if uid not in known]
+        if fresh:
+            _embed_many(fresh)
+
+        with write_lock:
+            # коллекцию и проверку наличия — только под локом: rebuild_collection()
+            # мог подменить и удалить старую, пока считались эмбеддинги
+            collection = _get_collection()
+            existing = collection.get(ids=ids, include=["metadatas"])
+
+            # уже есть в памяти — только счётчик и время последнего появления
+            upd_ids, upd_metas = [], []
+            for uid, meta in zip(existing.get("ids") or [], existing.get("metadatas") or []):
+                entry = grouped.pop(uid)
+                meta = dict(meta or {})
+                meta["first_seen"] = meta.get("first_seen", meta.get("timestamp", entry["ts"]))
+                meta["count"] = int(meta.get("count", 1)) + entry["n"]
+                meta["timestamp"] = entry["ts"]
+                meta["epoch"] = int(datetime.fromisoformat(entry["ts"]).timestamp())
+                upd_ids.append(uid)
+                upd_metas.append(meta)
+
+            new_ids, docs, metas = [], [], []
+            for uid, entry in grouped.items():
+                new_ids.append(uid)
+                docs.append(entry["doc"])
+                metas.append({
+                    "role": entry["role"],
+                    "timestamp": entry["ts"],
+                    "first_seen": entry["ts"],
+                    "count": entry["n"],
+                    # числовое время — для where-фильтров и затухания по давности
+                    "epoch": int(datetime.fromisoformat(entry["ts"]).timestamp()),
+                })
+
+            if upd_ids:
+                collection.update(ids=upd_ids, metadatas=upd_metas)
+            if new_ids:
+                collection.add(
+                    ids=new_ids,
+                    documents=docs,
+                    metadatas=metas,
+                    embeddings=_embed_many(docs),
+                )
     except Exception as e:
         print("Memory add error:", e)
 
-def search_memory(query: str, limit: int = 6):
 
-    if _collection.count() == 0:
-        return []
+def _writer() -> None:
+    stop = False
+    while not stop:
+        item = _write_q.get()
+        if item is None:
+            _write_q.task_done()
+            break
 
-    try:
-        res = _collection.query(
-            query_embeddings=[_embed(query)],
-            n_results=limit,
-            include=["documents", "metadatas", "distances"],
-        )
-    except Exception as e:
-        print("Memory search error:", e)
+        # добираем всё, что пришло за MEMORY_WRITE_BATCH_SEC
+        batch = [item]
+        deadline = time.time() + MEMORY_WRITE_BATCH_SEC
+        while len(batch) < MEMORY_WRITE_BATCH_MAX:
+            try:
+                nxt = _write_q.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if nxt is None:
+                stop = True
+                _write_q.task_done()
+                break
+            batch.append(nxt)
+
+        try:
+            _commit(batch)
+        finally:
+            for _ in batch:
+                _write_q.task_done()
+
+
+_writer_thread = threading.Thread(target=_writer, daemon=True)
+_writer_thread.start()
+
+
+@tracing.traced("memory.save")
+def save_memory(role: str, content: str):
+    """
+    Неблокирующая запись: документ уходит в фоновую очередь.
+    Если очередь переполнена — выкидываем самый старый документ.
+    """
+    ts = datetime.now().isoformat(timespec="seconds")
+    doc = f"{role}: {content}"
+
+    while True:
+        try:
+            _write_q.put_nowait((role, ts, doc))
+            return
+        except queue.Full:
+            try:
+                _write_q.get_nowait()
+                _write_q.task_done()
+                print("Memory backlog full: dropped oldest document")
+            except queue.Empty:
+                pass
+
+
+def flush_memory() -> None:
+    """Ждёт, пока все поставленные документы будут записаны."""
+    _write_q.join()
+
+
+def shutdown_memory(timeout: float = 10.0) -> None:
+    """Дописывает очередь, останавливает фоновый поток и сохраняет кэш эмбеддингов."""
+    if _writer_thread.is_alive():
+        _write_q.put(None)
+        _writer_thread.join(timeout)
+
+    if _embed_cache is not None:
+        _embed_cache.save()
+
+
+atexit.register(shutdown_memory)
+
+
+def _where(roles, since, until) -> dict | None:
+    clauses = []
+    if roles:
+        clauses.append({"role": {"$in": list(roles)}})
+    if since is not None:
+        clauses.append({"epoch": {"$gte": int(since)}})
+    if until is not None:
+        clauses.append({"epoch": {"$lte": int(until)}})
+
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses}
+
+
+def _rerank(dists, metas, embs, limit: int, now: float) -> list[int]:
+    """
+    Переранжирование кандидатов: похожесть + затухание по давности,
+    затем MMR, чтобы не брать несколько почти одинаковых воспоминаний.
+    """
+    sims = 1.0 - np.asarray(dists, dtype=np.float32)
+
+    epochs = np.array([(m or {}).get("epoch", now) for m in metas], dtype=np.float64)
+    age_days = np.clip(now - epochs, 0, None) / 86400.0
+    recency = np.power(0.5, age_days / MEMORY_RECENCY_HALF_LIFE_DAYS).astype(np.float32)
+
+    relevance = (1 - MEMORY_RECENCY_WEIGHT) * sims + MEMORY_RECENCY_WEIGHT * recency
+
+    # слишком далёкие по смыслу не спасает никакая свежесть
+    candidates = np.flatnonzero(sims >= 1.0 - MEMORY_MAX_DISTANCE)
+    if candidates.size == 0:
         return []
 
+    E = np.asarray(embs, dtype=np.float32)[candidates]
+    pair_sims = E @ E.T
+    rel = relevance[candidates]
+
+    selected: list[int] = []
+    max_sim = np.full(len(candidates), -np.inf, dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+
+    for _ in range(min(limit, len(candidates))):
+        if not available.any():
+            break
+        if selected:
+            score = MEMORY_MMR_LAMBDA * rel - (1 - MEMORY_MMR_LAMBDA) * max_sim
+        else:
+            score = rel.copy()
+        score[~available] = -np.inf
+
+        best = int(np.argmax(score))
+        selected.append(best)
+        available[best] = False
+        max_sim = np.maximum(max_sim, pair_sims[best])
+        # почти копии уже выбранного не берём вовсе — лучше вернуть меньше
+        available &= max_sim < 0.97
+
+    return [int(candidates[i]) for i in selected]
+
+
+@tracing.traced("memory.search")
+def search_memory(query: str, limit: int = 6, roles=None, since: float | None = None, until: float | None = None):
+    """
+    Поиск воспоминаний. roles — список ролей ("User", "Assistant", "Summary"),
+    since/until — границы по времени (unix epoch); фильтры выполняет сама Chroma.
+    Берётся limit * MEMORY_OVERFETCH ближайших, затем переранжирование
+    по похожести, давности и разнообразию (MMR).
+    """
+    query_embedding = _embed(query)
+
+    with _swap_lock:
+        collection = _get_collection()
+        count = collection.count()
+        if count == 0:
+            return []
+
+        query_args = {
+            "query_embeddings": [query_embedding],
+            "n_results": min(count, limit * MEMORY_OVERFETCH),
+            "include": ["documents", "metadatas", "distances", "embeddings"],
+        }
+        where = _where(roles, since, until)
+        if where is not None:
+            query_args["where"] = where
+
+        try:
+            res = collection.query(**query_args)
+        except Exception as e:
+            print("Memory search error:", e)
+            return []
+
     docs = (res.get("documents") or [[]])[0]
     metas = (res.get("metadatas") or [[]])[0]
     dists = (res.get("distances") or [[]])[0]
+    embs = res.get("embeddings")
+    embs = embs[0] if embs is not None and len(embs) else []
 
-    out = []
-
-    for doc, meta, dist in zip(docs, metas, dists):
-        if dist is not None and dist > 0.45:
-            continue
+    if not len(docs):
+        return []
 
-        ts = (meta or {}).get("timestamp", "")
-        out.append(f"[{ts}] {doc}")
+    out = []
+    for i in _rerank(dists, metas, embs, limit, time.time()):
+        ts = (metas[i] or {}).get("timestamp", "")
+        out.append(f"[{ts}] {docs[i]}")
 
-    return out
\ No newline at end of file
+    return out
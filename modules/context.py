@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import deque
+
+from config import (
+    OLLAMA_OPTIONS,
+    LLM_TOKENIZER_PATH,
+    LLM_CHARS_PER_TOKEN,
+    CONTEXT_MAX_TURNS,
+    CONTEXT_MEMORY_MAX_TOKENS,
+    CONTEXT_SYSTEM_AS_TURN,
+)
+
+# служебные токены шаблона чата на одно сообщение (роль, [INST] и т.п.)
+_MESSAGE_OVERHEAD = 8
+
+_tokenizer = None
+_tokenizer_loaded = False
+
+
+def _get_tokenizer():
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        if LLM_TOKENIZER_PATH and os.path.exists(LLM_TOKENIZER_PATH):
+            try:
+                from tokenizers import Tokenizer
+                _tokenizer = Tokenizer.from_file(LLM_TOKENIZER_PATH)
+            except Exception as e:
+                print("Context: токенайзер не загрузился, считаю по символам:", repr(e))
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """
+    Токены по токенайзеру модели (LLM_TOKENIZER_PATH, tokenizer.json),
+    а без него — оценка по LLM_CHARS_PER_TOKEN (с запасом для кириллицы).
+    """
+    tok = _get_tokenizer()
+    if tok is not None:
+        return len(tok.encode(text, add_special_tokens=False).ids)
+    return int(len(text) / LLM_CHARS_PER_TOKEN) + 1
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    # бинарный поиск по длине строки — токенайзер вызываем O(log n) раз
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens - 1:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + "…"
+
+
+# ответ модели на system-промпт, поданный первой репликой
+SYSTEM_ACK = "Понял."
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class ConversationContext:
+    """
+    Сборка промпта под фиксированный бюджет num_ctx.
+    Приоритет: system-промпт -> текущая реплика -> последние ходы диалога
+    (от новых к старым) -> воспоминания из памяти (без дублей, обрезанные).
+    Остаток бюджета резервируется под ответ (num_predict).
+
+    Чтобы Ollama брала начало промпта из KV-кэша, оно должно совпадать
+    от хода к ходу: system-промпт стоит в неизменной голове (см.
+    CONTEXT_SYSTEM_AS_TURN), а старые ходы выбрасываются сразу половиной
+    окна — префикс сдвигается раз в несколько ходов, а не каждый ход.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        max_turns: int = CONTEXT_MAX_TURNS,
+        system_as_turn: bool = CONTEXT_SYSTEM_AS_TURN,
+    ):
+        system_prompt = system_prompt.strip()
+        if system_as_turn:
+            self.head_messages = [
+                {"role": "user", "content": system_prompt},
+                {"role": "assistant", "content": SYSTEM_ACK},
+            ]
+        else:
+            self.head_messages = [{"role": "system", "content": system_prompt}]
+        self._system_tokens = sum(count_tokens(m["content"]) + _MESSAGE_OVERHEAD for m in self.head_messages)
+        self._max_messages = max_turns * 2
+        # сколько сообщений выкидывать за раз (чётное: пары вопрос+ответ)
+        self._evict = 2 * max(1, max_turns // 2)
+        self._turns: "deque[dict]" = deque()
+        self._lock = threading.Lock()
+        self.last_prompt_tokens = 0
+
+    @property
+    def budget(self) -> int:
+        num_ctx = OLLAMA_OPTIONS.get("num_ctx") or 2048
+        num_predict = OLLAMA_OPTIONS.get("num_predict") or 256
+        return num_ctx - num_predict
+
+    def add_turn(self, role: str, text: str) -> None:
+        if text:
+            with self._lock:
+                self._turns.append({"role": role, "content": text})
+                if len(self._turns) > self._max_messages:
+                    for _ in range(self._evict):
+                        self._turns.popleft()
+                    # idle-реплики без вопроса: история начинается с user
+                    while self._turns and self._turns[0]["role"] != "user":
+                        self._turns.popleft()
+
+    def _fit_history(self, budget: int) -> tuple[list[dict], int]:
+        with self._lock:
+            turns = list(self._turns)
+
+        picked = []
+        used = 0
+        for msg in reversed(turns):
+            cost = count_tokens(msg["content"]) + _MESSAGE_OVERHEAD
+            if used + cost > budget:
+                break
+            picked.append(msg)
+            used += cost
+        picked.reverse()
+
+        # история в чате должна начинаться с реплики пользователя
+        while picked and picked[0]["role"] != "user":
+            used -= count_tokens(picked[0]["content"]) + _MESSAGE_OVERHEAD
+            picked.pop(0)
+        return picked, used
+
+    def _fit_memories(self, memories: list[str], history: list[dict], budget: int) -> list[str]:
+        seen = {_normalize(m["content"]) for m in history}
+        out = []
+        used = 0
+        for mem in memories:
+            # "[ts] Role: текст" — дубль, если этот текст уже есть в истории
+            body = mem.split("] ", 1)[-1]
+            body = body.split(": ", 1)[-1]
+            key = _normalize(body)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            mem = _truncate(mem, CONTEXT_MEMORY_MAX_TOKENS)
+            cost = count_tokens(mem) + 1
+            if used + cost > budget:
+                break
+            out.append(mem)
+            used += cost
+        return out
+
+    def _assemble(self, head: str, tail: str, memories: list[str]) -> list[dict]:
+        budget = self.budget - self._system_tokens
+        fixed = count_tokens(head + tail) + _MESSAGE_OVERHEAD
+        budget -= fixed
+
+        history, history_tokens = self._fit_history(budget)
+        budget -= history_tokens
+
+        mems = self._fit_memories(memories, history, budget)
+        context = "".join(m + "\n" for m in mems)
+        content = head + (context or "(нет)\n") + tail
+
+        self.last_prompt_tokens = (
+            self._system_tokens + history_tokens + count_tokens(content) + _MESSAGE_OVERHEAD
+        )
+        return [*self.head_messages, *history, {"role": "user", "content": content}]
+
+    def build(self, user_text: str, memories: list[str]) -> list[dict]:
+        return self._assemble(
+            "Релевантные воспоминания из прошлых разговоров:\n",
+            f"\nПользователь: {user_text}",
+            memories,
+        )
+
+    def build_idle(self, memories: list[str]) -> list[dict]:
+        return self._assemble(
+            "Ситуация: пользователь молчит уже некоторое время.\n"
+            "Твоя задача — мягко и ненавязчиво начать разговор.\n"
+            "Скажи одну короткую фразу (1–2 предложения) и задай один вопрос.\n"
+            "Не будь навязчивым.\n\n"
+            "Релевантные воспоминания:\n",
+            "",
+            memories,
+        )
@@ -0,0 +1,12 @@
+import numpy as np
+
+
+def lowpass_fir(cutoff: float, taps: int = 63) -> np.ndarray:
+    """
+    FIR-фильтр нижних частот (windowed sinc, окно Хэмминга), единичное
+    усиление на нуле. cutoff — доля частоты дискретизации (0..0.5).
+    Общий для ресемплера микрофона и сдвига тона TTS.
+    """
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
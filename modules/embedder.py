@@ -0,0 +1,233 @@
+import hashlib
+import os
+import platform
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from config import EMBED_BACKEND, EMBED_ONNX_MODEL
+
+LOCAL_EMBED_PATH = os.path.join("models", "all-MiniLM-L6-v2")
+_ONNX_DIR = os.path.join(LOCAL_EMBED_PATH, "onnx")
+_MAX_SEQ_LENGTH = 256  # как в sentence_bert_config.json
+
+
+def _cpu_flags() -> set[str]:
+    """
+    Набор флагов CPU (avx2, avx512f, avx512_vnni, ...).
+    Порядок: py-cpuinfo (если есть) -> /proc/cpuinfo -> WinAPI.
+    """
+    try:
+        import cpuinfo
+        flags = set(cpuinfo.get_cpu_info().get("flags", []))
+        # py-cpuinfo пишет "avx512vnni", /proc/cpuinfo — "avx512_vnni"
+        if "avx512vnni" in flags:
+            flags.add("avx512_vnni")
+        return flags
+    except Exception:
+        pass
+
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+
+    if platform.system() == "Windows":
+        import ctypes
+        is_present = ctypes.windll.kernel32.IsProcessorFeaturePresent
+        flags = set()
+        if is_present(40):  # PF_AVX2_INSTRUCTIONS_AVAILABLE
+            flags.add("avx2")
+        if is_present(41):  # PF_AVX512F_INSTRUCTIONS_AVAILABLE
+            flags.add("avx512f")
+        return flags
+
+    return set()
+
+
+def pick_onnx_variant() -> str:
+    """
+    Лучший ONNX-файл из models/all-MiniLM-L6-v2/onnx под текущий CPU.
+    """
+    if EMBED_ONNX_MODEL:
+        return EMBED_ONNX_MODEL
+
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "model_qint8_arm64.onnx"
+
+    flags = _cpu_flags()
+    if "avx512_vnni" in flags:
+        return "model_qint8_avx512_vnni.onnx"
+    if "avx512f" in flags:
+        return "model_qint8_avx512.onnx"
+    if "avx2" in flags:
+        return "model_quint8_avx2.onnx"
+    # без квантизации, но с оптимизированным графом (O4 — fp16, только для GPU)
+    return "model_O3.onnx"
+
+
+class OnnxEmbedder:
+    """
+    all-MiniLM-L6-v2 через onnxruntime + tokenizer.json, без torch.
+    Mean pooling + L2-нормализация — как у SentenceTransformer.
+    """
+
+    def __init__(self, variant: str):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_id = f"all-MiniLM-L6-v2/onnx/{variant}"
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(LOCAL_EMBED_PATH, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=_MAX_SEQ_LENGTH)
+        # паддинг до самой длинной строки в батче, а не до фиксированных 128
+        self._tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(
+            os.path.join(_ONNX_DIR, variant),
+            sess_options=opts,
+            providers=["CPUExecutionProvider"],
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        encs = self._tokenizer.encode_batch(texts)
+        ids = np.array([e.ids for e in encs], dtype=np.int64)
+        mask = np.array([e.attention_mask for e in encs], dtype=np.int64)
+
+        feeds = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(ids)
+
+        hidden = self._session.run(None, feeds)[0]
+
+        m = mask[:, :, None].astype(np.float32)
+        pooled = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+
+class TorchEmbedder:
+    """
+    Исходный путь через sentence-transformers (тянет torch).
+    """
+
+    model_id = "all-MiniLM-L6-v2/torch"
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        self._model = SentenceTransformer(LOCAL_EMBED_PATH, local_files_only=True)
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        return self._model.encode(texts, normalize_embeddings=True)
+
+
+def load_embedder():
+    """
+    EMBED_BACKEND: "auto"/"onnx" — ONNX с откатом на torch, "torch" — только torch.
+    """
+    if EMBED_BACKEND != "torch":
+        variant = pick_onnx_variant()
+        try:
+            embedder = OnnxEmbedder(variant)
+            print("Embedder: onnx", variant)
+            return embedder
+        except Exception as e:
+            print(f"Embedder: onnx ({variant}) недоступен, откат на torch:", repr(e))
+
+    embedder = TorchEmbedder()
+    print("Embedder: torch")
+    return embedder
+
+
+def normalize_text(text: str) -> str:
+    # MiniLM uncased: регистр и лишние пробелы на эмбеддинг не влияют
+    return " ".join(text.lower().split())
+
+
+class EmbeddingCache:
+    """
+    LRU-кэш эмбеддингов. Ключ — blake2b(model_id + нормализованный текст),
+    так что кэш не перепутает векторы разных моделей/вариантов ONNX.
+    Если задан path — загружается с диска при старте и сохраняется через save().
+    """
+
+    def __init__(self, model_id: str, max_items: int, path: str | None = None):
+        self.model_id = model_id
+        self.max_items = max_items
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path:
+            self._load()
+
+    def key(self, text: str) -> str:
+        raw = f"{self.model_id}\0{normalize_text(text)}".encode("utf-8")
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def get(self, text: str) -> np.ndarray | None:
+        k = self.key(text)
+        with self._lock:
+            vec = self._items.get(k)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(k)
+            self.hits += 1
+            return vec
+
+    def put(self, text: str, vec: np.ndarray) -> None:
+        k = self.key(text)
+        with self._lock:
+            self._items[k] = np.asarray(vec, dtype=np.float32)
+            self._items.move_to_end(k)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data["model_id"]) != self.model_id:
+                    return  # другая модель — старые векторы не годятся
+                for k, vec in zip(data["keys"], data["vectors"]):
+                    self._items[str(k)] = vec
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        except Exception as e:
+            print("Embed cache load error:", e)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            if not self._items:
+                return
+            keys = np.array(list(self._items.keys()))
+            vectors = np.stack(list(self._items.values()))
+        try:
+            tmp = self.path + ".tmp.npz"
+            np.savez(tmp, model_id=np.array(self.model_id), keys=keys, vectors=vectors)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print("Embed cache save error:", e)
@@ -0,0 +1,157 @@
+import json
+import math
+import os
+import threading
+
+from config import (
+    STT_SILENCE_TIMEOUT,
+    STT_ENDPOINT_MIN_SEC,
+    STT_ENDPOINT_MAX_SEC,
+    STT_ENDPOINT_STABLE_BLOCKS,
+    STT_PREMATURE_WINDOW_SEC,
+    STT_ENDPOINT_STATS_PATH,
+)
+
+# фразы, после которых ждать продолжения незачем
+COMPLETE_PHRASES = {
+    "выход", "стоп", "закройся", "да", "нет", "спасибо", "пока", "привет",
+    "хватит", "понятно", "ладно", "хорошо", "окей", "отмена",
+}
+
+# если фраза оборвалась на таком слове — человек, скорее всего, думает
+HESITATION_TAILS = {
+    "и", "а", "но", "или", "что", "чтобы", "как", "если", "потому", "когда",
+    "ну", "э", "эм", "ммм", "это", "в", "на", "с", "по", "для", "к", "у", "о",
+    "который", "которая", "такой", "типа", "вот",
+}
+
+
+class AdaptiveEndpointer:
+    """
+    Решает, сколько ждать тишины перед концом фразы.
+
+    - Явно законченные фразы ("выход", "да") — минимум STT_ENDPOINT_MIN_SEC.
+    - Обрыв на союзе/предлоге/"ну" — максимум STT_ENDPOINT_MAX_SEC.
+    - Иначе — по выученной статистике пауз внутри фраз этого пользователя
+      (EMA среднего и дисперсии), короче, если partial давно не меняется.
+
+    Метрики: средняя задержка конца фразы и доля преждевременных обрывов
+    (пользователь продолжил говорить сразу после того, как мы закончили слушать).
+    """
+
+    def __init__(self, stats_path: str | None = STT_ENDPOINT_STATS_PATH):
+        self.stats_path = stats_path
+        self._lock = threading.Lock()
+
+        # выученные паузы внутри фраз, секунды
+        self.pause_mean = STT_SILENCE_TIMEOUT / 2
+        self.pause_var = 0.0
+        self.pause_samples = 0
+
+        self.endpoints = 0
+        self.premature = 0
+        self.delay_sum = 0.0
+
+        self._last_cut_ts = None
+        self._last_cut_voice_ts = None
+
+        if stats_path:
+            self._load()
+
+    # --- обучение ---
+
+    def _learn_pause(self, gap: float) -> None:
+        alpha = 0.1 if self.pause_samples >= 10 else 1.0 / (self.pause_samples + 1)
+        delta = gap - self.pause_mean
+        self.pause_mean += alpha * delta
+        self.pause_var = (1 - alpha) * (self.pause_var + alpha * delta * delta)
+        self.pause_samples += 1
+
+    def on_voice(self, now: float, prev_voice_ts: float, in_utterance: bool, block_sec: float) -> None:
+        """Вызывается на каждый блок речи (VAD или новый текст)."""
+        with self._lock:
+            # речь сразу после нашего "конца фразы" — обрезали слишком рано
+            if self._last_cut_ts is not None:
+                if now - self._last_cut_ts <= STT_PREMATURE_WINDOW_SEC:
+                    self.premature += 1
+                    self._learn_pause(now - self._last_cut_voice_ts)
+                self._last_cut_ts = None
+
+            # пауза внутри фразы, после которой человек продолжил
+            # (длиннее STT_ENDPOINT_MAX_SEC фраза уже закончилась бы сама)
+            gap = now - prev_voice_ts
+            if in_utterance and 1.5 * block_sec <= gap <= STT_ENDPOINT_MAX_SEC:
+                self._learn_pause(gap)
+
+    # --- решение ---
+
+    def timeout(self, text: str, stable_blocks: int) -> float:
+        words = text.lower().split()
+        if not words:
+            return STT_SILENCE_TIMEOUT
+
+        if " ".join(words) in COMPLETE_PHRASES:
+            return STT_ENDPOINT_MIN_SEC
+        if words[-1] in HESITATION_TAILS:
+            return STT_ENDPOINT_MAX_SEC
+
+        with self._lock:
+            if self.pause_samples >= 5:
+                # чуть дольше, чем типичная пауза-раздумье этого пользователя
+                wait = self.pause_mean + 2 * math.sqrt(self.pause_var) + 0.1
+            else:
+                wait = STT_SILENCE_TIMEOUT
+
+        if stable_blocks >= STT_ENDPOINT_STABLE_BLOCKS:
+            # распознаватель давно ничего нового не слышит
+            wait *= 0.75
+
+        return min(max(wait, STT_ENDPOINT_MIN_SEC), STT_ENDPOINT_MAX_SEC)
+
+    def on_endpoint(self, now: float, last_voice_ts: float) -> None:
+        with self._lock:
+            self.endpoints += 1
+            self.delay_sum += now - last_voice_ts
+            self._last_cut_ts = now
+            self._last_cut_voice_ts = last_voice_ts
+
+    # --- метрики и сохранение ---
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "endpoints": self.endpoints,
+                "avg_endpoint_delay": (self.delay_sum / self.endpoints) if self.endpoints else 0.0,
+                "premature": self.premature,
+                "premature_rate": (self.premature / self.endpoints) if self.endpoints else 0.0,
+                "pause_mean": round(self.pause_mean, 3),
+                "pause_std": round(math.sqrt(self.pause_var), 3),
+                "pause_samples": self.pause_samples,
+            }
+
+    def _load(self) -> None:
+        if not os.path.exists(self.stats_path):
+            return
+        try:
+            with open(self.stats_path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.pause_mean = float(data["pause_mean"])
+            self.pause_var = float(data["pause_var"])
+            self.pause_samples = int(data["pause_samples"])
+        except Exception as e:
+            print("Endpointer stats load error:", e)
+
+    def save(self) -> None:
+        if not self.stats_path:
+            return
+        with self._lock:
+            data = {
+                "pause_mean": self.pause_mean,
+                "pause_var": self.pause_var,
+                "pause_samples": self.pause_samples,
+            }
+        try:
+            with open(self.stats_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        except Exception as e:
+            print("Endpointer stats save error:", e)
@@ -1,20 +1,16 @@
 import requests
-from config import OLLAMA_URL, LLM_MODEL
+from config import LLM_MODEL
+from modules import tracing
+from modules.ollama_client import build_payload, build_chat_payload, generate, stream_chat
 
 
-def ask_llm(prompt: str) -> str:
+@tracing.traced("llm.generate")
+def ask_llm(prompt: str, options: dict | None = None) -> str:
 
-    payload = {
-        "model": LLM_MODEL,
-        "prompt": prompt,
-        "stream": False
-    }
+    payload = build_payload(LLM_MODEL, prompt, options)
 
     try:
-        r = requests.post(OLLAMA_URL, json=payload, timeout=120)
-        r.raise_for_status()
-
-        data = r.json()
+        data = generate(payload)
 
         # иногда Ollama возвращает без "response"
         if "response" not in data:
@@ -30,4 +26,24 @@ def ask_llm(prompt: str) -> str:
         return "Ошибка: модель слишком долго отвечает."
 
     except Exception as e:
-        return f"LLM error: {repr(e)}"
\ No newline at end of file
+        return f"LLM error: {repr(e)}"
+
+
+def ask_chat_stream(messages: list[dict], options: dict | None = None, cancel=None):
+    """
+    Стрим ответа через /api/chat. Начало messages (system-промпт и старые
+    ходы) одинаково от хода к ходу — Ollama не пересчитывает его заново.
+    """
+    payload = build_chat_payload(LLM_MODEL, messages, options)
+
+    try:
+        yield from stream_chat(payload, cancel=cancel)
+
+    except requests.exceptions.ConnectionError:
+        yield "Ошибка: Ollama не запущена."
+
+    except requests.exceptions.Timeout:
+        yield "Ошибка: модель слишком долго отвечает."
+
+    except Exception as e:
+        yield f"LLM error: {repr(e)}"
@@ -0,0 +1,209 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import modules.chroma_memory as memory
+from modules.llm import ask_llm
+from config import (
+    MEMORY_SUMMARIZE_AFTER_DAYS,
+    MEMORY_TTL_DAYS,
+    MEMORY_MAX_DOCS,
+    MEMORY_ARCHIVE_PATH,
+    MEMORY_REBUILD_RATIO,
+    MEMORY_COMPACT_INTERVAL_SEC,
+    MEMORY_SUMMARIZE_MAX_DAYS,
+    MEMORY_COMPACT_QUIET_SEC,
+)
+
+RAW_ROLES = ("User", "Assistant")
+SUMMARY_ROLE = "Summary"
+
+_SUMMARY_PROMPT = (
+    "Ниже реплики голосового диалога за {day}.\n"
+    "Сожми их в 3–5 коротких предложений: о чём говорили, что пользователь "
+    "рассказал о себе, о чём договорились. Только то, что явно сказано, без выдумок.\n\n"
+    "{transcript}\n\n"
+    "Краткое содержание:"
+)
+_TRANSCRIPT_MAX_CHARS = 6000
+
+# сколько документов удалено с последней пересборки индекса
+_deleted_since_rebuild = 0
+
+
+def _parse_ts(meta: dict) -> datetime | None:
+    try:
+        return datetime.fromisoformat((meta or {}).get("timestamp", ""))
+    except ValueError:
+        return None
+
+
+def _archive(ids, docs, metas, reason: str) -> None:
+    """Удаляемое не пропадает: дописываем в JSONL-архив."""
+    if not MEMORY_ARCHIVE_PATH or not ids:
+        return
+    with open(MEMORY_ARCHIVE_PATH, "a", encoding="utf-8") as f:
+        for uid, doc, meta in zip(ids, docs, metas):
+            f.write(json.dumps({"id": uid, "document": doc, "metadata": meta, "reason": reason}, ensure_ascii=False) + "\n")
+
+
+def _delete(collection, ids, docs, metas, reason: str) -> int:
+    global _deleted_since_rebuild
+    if not ids:
+        return 0
+    _archive(ids, docs, metas, reason)
+    with memory.write_lock:
+        collection.delete(ids=list(ids))
+    _deleted_since_rebuild += len(ids)
+    return len(ids)
+
+
+def _wait_quiet(is_busy, quiet_sec: float = MEMORY_COMPACT_QUIET_SEC) -> None:
+    """Ждёт, пока ассистент простоит без дела quiet_sec подряд (is_busy() — False)."""
+    if is_busy is None:
+        return
+    quiet_since = time.time()
+    while True:
+        if is_busy():
+            quiet_since = time.time()
+        elif time.time() - quiet_since >= quiet_sec:
+            return
+        time.sleep(1.0)
+
+
+def _summarize_day(day: str, docs: list[str]) -> str:
+    transcript = "\n".join(docs)
+    if len(transcript) > _TRANSCRIPT_MAX_CHARS:
+        transcript = transcript[-_TRANSCRIPT_MAX_CHARS:]
+
+    summary = ask_llm(_SUMMARY_PROMPT.format(day=day, transcript=transcript), options={"num_predict": 200})
+    # ask_llm при ошибке возвращает текст ошибки — такой "summary" не сохраняем
+    if not summary or summary.startswith(("Ошибка", "LLM error")):
+        return ""
+    return summary.strip()
+
+
+def _roll_up(collection, items, now: datetime, is_busy=None) -> dict:
+    """
+    Старые сырые реплики -> по одному summary на день, оригиналы в архив.
+    За проход — не больше MEMORY_SUMMARIZE_MAX_DAYS самых старых дней, и
+    каждый вызов LLM только в паузе разговора: Ollama одна на всё.
+    """
+    cutoff = now - timedelta(days=MEMORY_SUMMARIZE_AFTER_DAYS)
+    by_day = defaultdict(list)
+    for uid, doc, meta, ts in items:
+        if meta.get("role") in RAW_ROLES and ts is not None and ts < cutoff:
+            by_day[ts.date().isoformat()].append((ts, uid, doc, meta))
+
+    summarized = 0
+    days = sorted(by_day.items())[:MEMORY_SUMMARIZE_MAX_DAYS]
+    for day, rows in days:
+        rows.sort()
+        _wait_quiet(is_busy)
+        summary = _summarize_day(day, [doc for _, _, doc, _ in rows])
+        if not summary:
+            continue
+
+        doc = f"{SUMMARY_ROLE}: [{day}] {summary}"
+        ts = rows[-1][0].isoformat(timespec="seconds")
+        with memory.write_lock:
+            collection.add(
+                ids=[f"summary-{day}-{int(time.time())}"],
+                documents=[doc],
+                metadatas=[{
+                    "role": SUMMARY_ROLE,
+                    "timestamp": ts,
+                    "epoch": int(rows[-1][0].timestamp()),
+                    "source_count": len(rows),
+                }],
+                embeddings=memory._embed_many([doc]),
+            )
+        summarized += _delete(
+            collection,
+            [r[1] for r in rows], [r[2] for r in rows], [r[3] for r in rows],
+            reason=f"summarized:{day}",
+        )
+    return {"summarized": summarized, "days": len(days), "days_left": len(by_day) - len(days)}
+
+
+def _apply_retention(collection, items, now: datetime) -> dict:
+    """TTL для всего и жёсткий потолок размера (сначала уходят самые старые)."""
+    expired = []
+    if MEMORY_TTL_DAYS:
+        cutoff = now - timedelta(days=MEMORY_TTL_DAYS)
+        expired = [it for it in items if it[3] is not None and it[3] < cutoff]
+
+    expired_ids = {it[0] for it in expired}
+    rest = [it for it in items if it[0] not in expired_ids]
+
+    over = []
+    if MEMORY_MAX_DOCS and len(rest) > MEMORY_MAX_DOCS:
+        rest.sort(key=lambda it: it[3] or datetime.min)
+        over = rest[:len(rest) - MEMORY_MAX_DOCS]
+
+    removed = _delete(collection, [it[0] for it in expired], [it[1] for it in expired], [it[2] for it in expired], "ttl")
+    removed_cap = _delete(collection, [it[0] for it in over], [it[1] for it in over], [it[2] for it in over], "size_cap")
+    return {"expired": removed, "capped": removed_cap}
+
+
+def _rebuild_index() -> None:
+    global _deleted_since_rebuild
+    memory.rebuild_collection()
+    _deleted_since_rebuild = 0
+
+
+def compact_once(is_busy=None) -> dict:
+    """
+    Один проход: свёртка старых реплик, TTL/потолок, при необходимости пересборка.
+    is_busy() -> True, пока идёт ход разговора (свёртка его не задерживает).
+    """
+    t0 = time.perf_counter()
+    collection = memory._get_collection()
+    now = datetime.now()
+
+    data = collection.get(include=["documents", "metadatas"])
+    items = [
+        (uid, doc, meta or {}, _parse_ts(meta))
+        for uid, doc, meta in zip(data.get("ids") or [], data.get("documents") or [], data.get("metadatas") or [])
+    ]
+
+    report = _roll_up(collection, items, now, is_busy)
+
+    data = collection.get(include=["documents", "metadatas"])
+    items = [
+        (uid, doc, meta or {}, _parse_ts(meta))
+        for uid, doc, meta in zip(data.get("ids") or [], data.get("documents") or [], data.get("metadatas") or [])
+    ]
+    report.update(_apply_retention(collection, items, now))
+
+    live = collection.count()
+    report["live"] = live
+    if _deleted_since_rebuild and _deleted_since_rebuild >= MEMORY_REBUILD_RATIO * max(live, 1):
+        _rebuild_index()
+        report["rebuilt"] = True
+
+    report["sec"] = round(time.perf_counter() - t0, 2)
+    print("Memory compaction:", report)
+    return report
+
+
+def start_compaction(
+    interval_sec: float = MEMORY_COMPACT_INTERVAL_SEC,
+    first_delay_sec: float = 600,
+    is_busy=None,
+) -> threading.Thread:
+    """Фоновая компакция раз в interval_sec; первый проход — через first_delay_sec."""
+    def loop():
+        time.sleep(first_delay_sec)
+        while True:
+            try:
+                compact_once(is_busy)
+            except Exception as e:
+                print("Memory compaction error:", repr(e))
+            time.sleep(interval_sec)
+
+    t = threading.Thread(target=loop, daemon=True)
+    t.start()
+    return t
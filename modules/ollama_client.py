@@ -0,0 +1,216 @@
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import tracing
+from config import (
+    OLLAMA_URL,
+    OLLAMA_CHAT_URL,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_OPTIONS,
+    OLLAMA_WARMUP_MODELS,
+)
+
+# Одна сессия на весь процесс: TCP-соединение с Ollama переиспользуется между ходами
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+# prompt eval по ходам: сколько токенов промпта модель реально пересчитала
+# (при переиспользовании префикса через KV-кэш Ollama это число падает)
+last_stats: dict = {}
+_totals = {"turns": 0, "prompt_eval_count": 0, "prompt_eval_sec": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _merge_options(options: dict | None) -> dict:
+    # None в конфиге = "оставить по умолчанию Ollama"
+    merged = {k: v for k, v in OLLAMA_OPTIONS.items() if v is not None}
+    if options:
+        merged.update({k: v for k, v in options.items() if v is not None})
+    return merged
+
+
+def build_payload(model: str, prompt: str, options: dict | None = None, **extra) -> dict:
+    """
+    Тело запроса /api/generate с keep_alive и options (num_ctx, num_thread, num_predict, ...).
+    """
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+    }
+    merged = _merge_options(options)
+    if merged:
+        payload["options"] = merged
+    payload.update(extra)
+    return payload
+
+
+def build_chat_payload(model: str, messages: list[dict], options: dict | None = None, **extra) -> dict:
+    """
+    Тело запроса /api/chat. messages собирает ConversationContext так,
+    чтобы начало было одинаковым от хода к ходу и Ollama брала его из KV-кэша.
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+    }
+    merged = _merge_options(options)
+    if merged:
+        payload["options"] = merged
+    payload.update(extra)
+    return payload
+
+
+def _record_stats(data: dict) -> None:
+    """Финальный чанк Ollama: считаем prompt eval и печатаем строку отчёта."""
+    global last_stats
+    stats = {
+        "prompt_eval_count": data.get("prompt_eval_count", 0),
+        "prompt_eval_sec": data.get("prompt_eval_duration", 0) / 1e9,
+        "eval_count": data.get("eval_count", 0),
+        "eval_sec": data.get("eval_duration", 0) / 1e9,
+    }
+    with _stats_lock:
+        last_stats = stats
+        _totals["turns"] += 1
+        _totals["prompt_eval_count"] += stats["prompt_eval_count"]
+        _totals["prompt_eval_sec"] += stats["prompt_eval_sec"]
+
+    print(
+        f"LLM: prompt eval {stats['prompt_eval_count']} tok / {stats['prompt_eval_sec']:.2f} s, "
+        f"ответ {stats['eval_count']} tok / {stats['eval_sec']:.2f} s"
+    )
+
+
+def prompt_eval_report() -> dict:
+    """Средний prompt eval за ход с начала работы."""
+    with _stats_lock:
+        turns = _totals["turns"]
+        return {
+            "turns": turns,
+            "avg_prompt_eval_count": (_totals["prompt_eval_count"] / turns) if turns else 0.0,
+            "avg_prompt_eval_sec": (_totals["prompt_eval_sec"] / turns) if turns else 0.0,
+            "last": dict(last_stats),
+        }
+
+
+def generate(payload: dict, timeout: float = 120) -> dict:
+    """
+    Нестримовый запрос. Возвращает JSON Ollama как есть.
+    """
+    payload = dict(payload, stream=False)
+    r = _session.post(OLLAMA_URL, json=payload, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+
+def _stream(url: str, payload: dict, extract, timeout: float, cancel: threading.Event | None):
+    """
+    Общий разбор NDJSON-стрима Ollama. extract(data) достаёт текст токена из чанка.
+    Ошибки соединения пробрасываются наружу — их текст решает вызывающий.
+    Если выставлен cancel — соединение закрывается, и Ollama прекращает генерацию.
+    """
+    payload = dict(payload, stream=True)
+    t0 = time.perf_counter()
+    first = True
+
+    with _session.post(url, json=payload, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+
+        finished = threading.Event()
+        if cancel is not None:
+            # отмена должна сработать и во время prompt eval, когда строк ещё нет
+            threading.Thread(target=_close_on_cancel, args=(r, cancel, finished), daemon=True).start()
+
+        try:
+            for line in r.iter_lines():
+                if cancel is not None and cancel.is_set():
+                    return
+
+                if not line:
+                    continue
+
+                data = json.loads(line)
+
+                if "error" in data:
+                    print("LLM stream error:", data["error"])
+                    return
+
+                token = extract(data)
+                if token:
+                    if first:
+                        first = False
+                        tracing.observe("llm.first_token", time.perf_counter() - t0, model=payload.get("model"))
+                    yield token
+
+                if data.get("done"):
+                    _record_stats(data)
+                    tracing.observe("llm.stream", time.perf_counter() - t0,
+                                    model=payload.get("model"),
+                                    prompt_eval_count=data.get("prompt_eval_count"),
+                                    eval_count=data.get("eval_count"))
+                    return
+
+        except Exception:
+            # соединение закрыли из-за отмены — это не ошибка
+            if cancel is not None and cancel.is_set():
+                return
+            raise
+
+        finally:
+            finished.set()
+
+
+def stream_generate(payload: dict, timeout: float = 120, cancel: threading.Event | None = None):
+    """Токены из /api/generate ("response" в каждом чанке)."""
+    return _stream(OLLAMA_URL, payload, lambda d: d.get("response") or "", timeout, cancel)
+
+
+def stream_chat(payload: dict, timeout: float = 120, cancel: threading.Event | None = None):
+    """Токены из /api/chat ("message.content" в каждом чанке)."""
+    return _stream(OLLAMA_CHAT_URL, payload, lambda d: (d.get("message") or {}).get("content") or "", timeout, cancel)
+
+
+def _close_on_cancel(response, cancel: threading.Event, finished: threading.Event) -> None:
+    while not finished.is_set():
+        if cancel.wait(0.1):
+            response.close()
+            return
+
+
+def _load_model(model: str) -> None:
+    # пустой prompt: Ollama только загружает модель в память и держит keep_alive.
+    # options те же, что у настоящих запросов: другой num_ctx = перезагрузка модели
+    payload = {"model": model, "keep_alive": OLLAMA_KEEP_ALIVE, "stream": False}
+    merged = _merge_options(None)
+    if merged:
+        payload["options"] = merged
+    try:
+        _session.post(OLLAMA_URL, json=payload, timeout=300).raise_for_status()
+        print(f"Ollama: модель {model} загружена")
+    except Exception as e:
+        print(f"Ollama warm-up error ({model}):", repr(e))
+
+
+def warm_up(models=None, background: bool = True) -> None:
+    """
+    Прогревает модели (по умолчанию OLLAMA_WARMUP_MODELS), чтобы первый
+    настоящий вопрос не ждал загрузки весов.
+    """
+    models = list(OLLAMA_WARMUP_MODELS if models is None else models)
+
+    def run():
+        for model in models:
+            _load_model(model)
+
+    if background:
+        threading.Thread(target=run, daemon=True).start()
+    else:
+        run()
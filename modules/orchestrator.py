@@ -0,0 +1,353 @@
+import asyncio
+import functools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import modules.speech_to_text as stt
+import modules.text_to_speech as tts
+from modules import tracing
+from modules.chroma_memory import save_memory, search_memory
+from modules.llm import ask_chat_stream
+from modules.speculation import SpeculativeTurn
+from modules.vision import ask_vision_stream
+from config import LLM_SPECULATIVE, STT_MIN_WORDS
+
+FALLBACK_ANSWER = "Я не получил ответ. Проверь, запущена ли Ollama и правильна ли модель."
+IDLE_QUERY = "последняя тема разговора интересы предпочтения"
+IDLE_LOOKBACK_SEC = 14 * 86400   # для idle-реплики интересно свежее: последние две недели
+
+# как часто listen() возвращает управление без речи (реакция на остановку)
+_LISTEN_SLICE_SEC = 0.5
+
+# listen() упал (микрофон не открылся, отвалилось устройство): столько
+# попыток подряд с растущей паузой, дальше ошибка останавливает run()
+_STT_MAX_FAILURES = 5
+_STT_RETRY_SEC = 1.0
+
+# хвост перебитого ответа: в истории и памяти видно, что он оборван
+INTERRUPTED_MARK = "…"
+
+
+class Orchestrator:
+    """
+    Разговорный цикл на asyncio. Независимые стадии — отдельные задачи:
+
+      stt       listen() в своём потоке -> очередь фраз; перебивание во время
+                TTS отменяет текущий ход
+      dispatch  фраза -> ход (новая фраза отменяет недоделанный старый ход)
+      turn      поиск по памяти -> стрим LLM -> фразы в TTS (критический путь);
+                живёт, пока ответ звучит, — перебитый ответ сохраняется
+                только в той части, что успела прозвучать
+      persist   очередь реплик -> save_memory (вне критического пути)
+      idle      таймер idle-реплики; listen() при этом не останавливается
+
+    Блокирующие вызовы (Vosk, Chroma, Ollama) уходят в потоки; сам цикл
+    только раскладывает результаты по очередям.
+    """
+
+    def __init__(self, conversation, exit_words, is_vision, idle_interval: tuple[float, float]):
+        self.conversation = conversation
+        self.exit_words = exit_words
+        self.is_vision = is_vision
+        self.idle_interval = idle_interval
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._utterances: asyncio.Queue | None = None
+        self._persist_q: asyncio.Queue | None = None
+        # listen() не потокобезопасен — один выделенный поток
+        self._stt_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stt")
+        self._running = False
+        self._turn: asyncio.Task | None = None
+        # ссылки на задачи ходов: цикл держит задачи только слабо
+        self._tasks: set[asyncio.Task] = set()
+        self._speculation: SpeculativeTurn | None = None
+        self._next_idle_at = 0.0
+        # ошибка фоновой задачи, из-за которой run() остановился
+        self._failure: BaseException | None = None
+
+    # ---------- вход ----------
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._utterances = asyncio.Queue()
+        self._persist_q = asyncio.Queue()
+        self._running = True
+        self._schedule_idle()
+
+        dispatch = asyncio.create_task(self._dispatch(), name="dispatch")
+        background = [
+            asyncio.create_task(self._stt_task(), name="stt"),
+            asyncio.create_task(self._persist_task(), name="persist"),
+            asyncio.create_task(self._idle_task(), name="idle"),
+        ]
+        for task in background:
+            task.add_done_callback(functools.partial(self._background_done, dispatch))
+        try:
+            await dispatch
+        except asyncio.CancelledError:
+            if self._failure is None:
+                raise
+            raise self._failure from None
+        finally:
+            self._running = False
+            await self._cancel_turn()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            # недописанное в память всё равно сохраняем
+            if not background[1].done():
+                await self._persist_q.join()
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            self._stt_pool.shutdown(wait=False)
+
+    def _background_done(self, dispatch: asyncio.Task, task: asyncio.Task) -> None:
+        # фоновые задачи живут до конца run(): выход сам по себе — уже ошибка
+        if task.cancelled() or not self._running:
+            return
+        exc = task.exception()
+        print(f"Task {task.get_name()} stopped:", repr(exc))
+        self._failure = exc or RuntimeError(f"task {task.get_name()} exited")
+        dispatch.cancel()
+
+    # ---------- STT ----------
+
+    def _on_partial_threadsafe(self, partial: str) -> None:
+        # вызывается из потока STT
+        self._loop.call_soon_threadsafe(self._on_partial, partial)
+
+    def _on_partial(self, partial: str) -> None:
+        # partial устоялся — начинаем готовить ответ, не дожидаясь конца фразы
+        if self._speculation is not None:
+            if self._speculation.matches(partial):
+                return
+            self._speculation.cancel()
+            self._speculation = None
+
+        if (
+            LLM_SPECULATIVE
+            and len(partial.split()) >= STT_MIN_WORDS
+            and partial.lower() not in self.exit_words
+            and not self.is_vision(partial)
+        ):
+            self._speculation = SpeculativeTurn(partial, self._answer_stream)
+
+    def _on_barge_in_threadsafe(self) -> None:
+        # вызывается из потока STT; звук TTS к этому моменту уже заглушён
+        self._loop.call_soon_threadsafe(self._on_barge_in)
+
+    def _on_barge_in(self) -> None:
+        # пользователь перебил — генерация ответа больше не нужна
+        self._schedule_idle()
+        if self._turn is not None and not self._turn.done():
+            self._turn.cancel()
+        tts.clear()
+
+    async def _stt_task(self) -> None:
+        failures = 0
+        while self._running:
+            try:
+                text = await self._loop.run_in_executor(
+                    self._stt_pool, stt.listen, _LISTEN_SLICE_SEC,
+                    self._on_partial_threadsafe, self._on_barge_in_threadsafe,
+                )
+            except Exception as e:
+                failures += 1
+                print(f"STT exception ({failures}/{_STT_MAX_FAILURES}):", repr(e))
+                if failures >= _STT_MAX_FAILURES:
+                    raise
+                await asyncio.sleep(_STT_RETRY_SEC * 2 ** (failures - 1))
+                continue
+            failures = 0
+            text = (text or "").strip()
+            if text:
+                await self._utterances.put(text)
+
+    # ---------- ходы ----------
+
+    async def _dispatch(self) -> None:
+        while True:
+            text = await self._utterances.get()
+
+            spec, self._speculation = self._speculation, None
+            if spec is not None and not spec.matches(text):
+                # фраза закончилась иначе, чем предполагали, — обрываем стрим Ollama
+                spec.cancel()
+                spec = None
+
+            # новая фраза делает недоделанный ответ (и idle-реплику) неактуальным
+            await self._cancel_turn()
+            self._schedule_idle()
+
+            print("You:", text)
+
+            if text.lower() in self.exit_words:
+                tts.speak("Выключаюсь")
+                return
+
+            self._start_turn(self._user_turn(text, spec))
+
+    def _start_turn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._turn_done)
+        self._turn = task
+
+    def _turn_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # иначе исключение хода потерялось бы молча
+            print("Turn exception:", repr(task.exception()))
+
+    async def _cancel_turn(self) -> None:
+        turn, self._turn = self._turn, None
+        if turn is not None and not turn.done():
+            turn.cancel()
+            await asyncio.gather(turn, return_exceptions=True)
+
+    def _answer_stream(self, text: str, cancel=None):
+        """Поиск по памяти + стрим ответа LLM (для спекуляции, в её потоке)."""
+        try:
+            relevant = search_memory(text, limit=4)
+        except Exception:
+            relevant = []
+
+        return ask_chat_stream(self.conversation.build(text, relevant), cancel=cancel)
+
+    async def _user_turn(self, text: str, spec: SpeculativeTurn | None) -> None:
+        tracing.new_turn()
+        cancel = threading.Event()
+        spoken: list[str] = []
+        try:
+            with tracing.span("turn.answer") as turn_span:
+                if self.is_vision(text):
+                    turn_span.set(path="vision")
+                    tokens = ask_vision_stream(text, cancel=cancel)
+                elif spec is not None:
+                    # спекуляция угадала фразу — ответ уже генерируется (или готов)
+                    turn_span.set(path="speculative")
+                    tokens = spec.tokens()
+                else:
+                    turn_span.set(path="normal")
+                    try:
+                        relevant = await asyncio.to_thread(search_memory, text, limit=4)
+                    except Exception:
+                        relevant = []
+                    tokens = ask_chat_stream(self.conversation.build(text, relevant), cancel=cancel)
+
+                answer = (await self._speak(tokens, cancel, spoken)).strip()
+
+            if not answer:
+                answer = FALLBACK_ANSWER
+                tts.speak(answer)
+
+            # стрим кончился раньше звука: перебивание ещё может отменить ход
+            await asyncio.to_thread(tts.wait_idle)
+
+        except asyncio.CancelledError:
+            # ход устарел: обрываем Ollama и выкидываем ещё не озвученное
+            cancel.set()
+            if spec is not None:
+                spec.cancel()
+            tts.clear()
+            if spoken:
+                # пользователь слышал только начало — его и запоминаем
+                self._remember(text, " ".join(spoken) + INTERRUPTED_MARK)
+            raise
+
+        self._remember(text, answer)
+
+    def _remember(self, text: str, answer: str) -> None:
+        # короткая память диалога (в промпт следующих ходов)
+        self.conversation.add_turn("user", text)
+        self.conversation.add_turn("assistant", answer)
+
+        # сохранение — отдельной задачей, ход на него не ждёт
+        self._persist_q.put_nowait(("User", text))
+        self._persist_q.put_nowait(("Assistant", answer))
+
+        print("Jarvis:", answer)
+
+    async def _speak(self, tokens, cancel: threading.Event, spoken: list[str]) -> str:
+        """
+        Стрим LLM -> готовые предложения в TTS (tts.speak_stream в потоке).
+        Возвращает полный текст ответа; в spoken по мере воспроизведения
+        дописываются фразы, доигранные до конца.
+        """
+        def guarded():
+            try:
+                yield from tokens
+            except Exception as e:
+                print("LLM stream exception:", repr(e))
+
+        # при отмене хода поток выходит сам: cancel закрывает стрим Ollama,
+        # а уже поставленные фразы выкидывает tts.clear()
+        return await asyncio.to_thread(tts.speak_stream, guarded(), spoken.append, cancel)
+
+    # ---------- idle ----------
+
+    def _schedule_idle(self) -> None:
+        self._next_idle_at = time.time() + random.uniform(*self.idle_interval)
+
+    def busy(self) -> bool:
+        """Идёт ход, говорит TTS или пользователь посреди фразы (из любого потока)."""
+        return (
+            (self._turn is not None and not self._turn.done())
+            or tts.is_speaking
+            or stt.in_phrase()
+        )
+
+    async def _idle_task(self) -> None:
+        while True:
+            await asyncio.sleep(max(0.0, self._next_idle_at - time.time()))
+            if time.time() < self._next_idle_at:
+                # пока спали, пользователь что-то сказал — таймер сдвинулся
+                continue
+            if not self.busy():
+                self._start_turn(self._idle_turn())
+            # планируем следующий “пинг” позже
+            self._schedule_idle()
+
+    async def _idle_turn(self) -> None:
+        tracing.new_turn()
+        cancel = threading.Event()
+        spoken: list[str] = []
+        try:
+            with tracing.span("turn.idle"):
+                try:
+                    context_list = await asyncio.to_thread(
+                        search_memory, IDLE_QUERY, limit=4, since=time.time() - IDLE_LOOKBACK_SEC
+                    )
+                except Exception:
+                    context_list = []
+
+                tokens = ask_chat_stream(self.conversation.build_idle(context_list), cancel=cancel)
+                idle_answer = (await self._speak(tokens, cancel, spoken)).strip()
+
+            await asyncio.to_thread(tts.wait_idle)
+
+        except asyncio.CancelledError:
+            cancel.set()
+            tts.clear()
+            if spoken:
+                self.conversation.add_turn("assistant", " ".join(spoken) + INTERRUPTED_MARK)
+            raise
+
+        if idle_answer:
+            print("Jarvis (idle):", idle_answer)
+            self.conversation.add_turn("assistant", idle_answer)
+
+    # ---------- память ----------
+
+    async def _persist_task(self) -> None:
+        while True:
+            role, content = await self._persist_q.get()
+            try:
+                await asyncio.to_thread(save_memory, role, content)
+            except Exception:
+                pass
+            finally:
+                self._persist_q.task_done()
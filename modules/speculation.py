@@ -0,0 +1,68 @@
+import threading
+
+from modules import tracing
+
+# счётчики: сколько спекуляций пригодилось / отброшено
+stats = {"started": 0, "hits": 0, "cancelled": 0}
+tracing.register_gauges("speculation", lambda: dict(stats))
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class SpeculativeTurn:
+    """
+    Ответ, который начинают готовить по стабильному partial, пока listen()
+    ещё ждёт конца фразы. make_stream(text, cancel) должен вернуть генератор
+    токенов (поиск по памяти + стрим LLM). Токены копятся в буфере;
+    если финальный текст совпал — tokens() отдаёт накопленное и дочитывает
+    стрим дальше, если нет — cancel() обрывает запрос к Ollama.
+    """
+
+    def __init__(self, text: str, make_stream):
+        self.text = text
+        self._cancel = threading.Event()
+        self._tokens: list[str] = []
+        self._done = False
+        self._cond = threading.Condition()
+
+        stats["started"] += 1
+        self._thread = threading.Thread(target=self._run, args=(make_stream,), daemon=True)
+        self._thread.start()
+
+    def _run(self, make_stream) -> None:
+        try:
+            for token in make_stream(self.text, self._cancel):
+                if self._cancel.is_set():
+                    break
+                with self._cond:
+                    self._tokens.append(token)
+                    self._cond.notify_all()
+        except Exception as e:
+            print("Speculation error:", repr(e))
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def matches(self, text: str) -> bool:
+        return _normalize(text) == _normalize(self.text)
+
+    def cancel(self) -> None:
+        if not self._cancel.is_set():
+            self._cancel.set()
+            stats["cancelled"] += 1
+
+    def tokens(self):
+        """Принять результат: уже готовые токены и все последующие."""
+        stats["hits"] += 1
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: i < len(self._tokens) or self._done)
+                if i >= len(self._tokens):
+                    return
+                chunk = self._tokens[i:]
+            i += len(chunk)
+            yield from chunk
@@ -1,57 +1,347 @@
+import atexit
 import json
-import queue
+import threading
 import time
+from collections import deque
 
+import numpy as np
 import sounddevice as sd
 from vosk import Model, KaldiRecognizer
 
 import modules.text_to_speech as tts
+from modules import tracing
+from modules.audio_ring import PcmRingBuffer
+from modules.dsp import lowpass_fir
+from modules.endpointer import AdaptiveEndpointer, COMPLETE_PHRASES
 from config import (
     VOSK_MODEL_PATH,
     STT_DEVICE_INDEX,
     STT_SAMPLE_RATE,
+    STT_MODEL_RATE,
     STT_BLOCK_SEC,
-    STT_SILENCE_TIMEOUT,
+    STT_RING_SEC,
     STT_MIN_WORDS,
+    EXIT_WORDS,
     STT_MAX_UTTERANCE_SEC,
+    STT_SPECULATE_STABLE_SEC,
+    STT_VAD_ENABLED,
+    STT_VAD_THRESHOLD_DB,
+    STT_VAD_MARGIN_DB,
+    STT_VAD_HANGOVER_BLOCKS,
+    STT_VAD_PREROLL_BLOCKS,
+    STT_VAD_NOISE_WINDOW_SEC,
+    STT_VAD_NOISE_RISE,
+    STT_BARGE_IN,
+    STT_BARGE_IN_FRAME_SEC,
+    STT_BARGE_IN_MIN_FRAMES,
+    STT_BARGE_IN_MARGIN_DB,
+    STT_BARGE_IN_COUPLING_DB,
+    STT_BARGE_IN_PREROLL_SEC,
 )
 
 _model = None
+_model_lock = threading.Lock()
 _rec = None
-_q: "queue.Queue[bytes]" = queue.Queue()
+_ring: PcmRingBuffer | None = None
+_block = 0  # сэмплов в блоке на частоте захвата
+_frame = 0  # сэмплов в кадре barge-in на частоте захвата
 _stream = None
+_resampler = None
 
 _last_voice_ts = 0.0
 _utt_start_ts = 0.0
 _best_text = ""
+_stable_blocks = 0  # сколько блоков подряд текст не менялся
+_text_changed_ts = 0.0
+_reported_partial = ""  # какой стабильный partial уже отдан в on_partial
+_barge_in = False  # фразу начали, перебив TTS: пока она идёт, TTS уже не «говорит»
 
+_endpointer = AdaptiveEndpointer()
+atexit.register(_endpointer.save)
 
-def _init():
-    global _model, _rec, _stream, _last_voice_ts, _utt_start_ts, _best_text
-    if _stream is not None:
-        return
 
-    if STT_DEVICE_INDEX is not None:
-        sd.default.device = (STT_DEVICE_INDEX, None)
+def block_level_db(data) -> float:
+    """RMS блока int16 в dBFS."""
+    x = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+    if x.size == 0:
+        return -120.0
+    rms = np.sqrt(np.mean(x * x)) / 32768.0
+    return float(20.0 * np.log10(rms + 1e-10))
+
+
+class EnergyVad:
+    """
+    Энергетический VAD перед Vosk: в тишине Kaldi не декодирует вообще.
+    Порог = max(абсолютный порог, уровень шума + margin); уровень шума
+    подстраивается по блокам без речи, а вверх ещё и по минимуму уровня
+    за окно (minimum statistics) — иначе ровный фон громче порога считался
+    бы речью вечно и шум никогда бы не выучился. После речи ещё hangover блоков
+    отдаются распознавателю (хвосты слов), а перед началом речи —
+    pre-roll блоков из буфера (начало первого слова).
+    """
+
+    def __init__(
+        self,
+        threshold_db: float = STT_VAD_THRESHOLD_DB,
+        margin_db: float = STT_VAD_MARGIN_DB,
+        hangover_blocks: int = STT_VAD_HANGOVER_BLOCKS,
+        preroll_blocks: int = STT_VAD_PREROLL_BLOCKS,
+        noise_window_blocks: int = max(1, int(round(STT_VAD_NOISE_WINDOW_SEC / STT_BLOCK_SEC))),
+        noise_rise: float = STT_VAD_NOISE_RISE,
+    ):
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.hangover_blocks = hangover_blocks
+        self.noise_db = threshold_db - margin_db
+        self._preroll: "deque[np.ndarray]" = deque(maxlen=max(0, preroll_blocks))
+        self._hangover = 0
+        self._levels: "deque[float]" = deque(maxlen=noise_window_blocks)
+        self.noise_rise = noise_rise
+        self.speech = False  # был ли последний блок речью
+        self.decoded = 0
+        self.skipped = 0
+
+    def is_speech(self, level_db: float) -> bool:
+        return level_db > max(self.threshold_db, self.noise_db + self.margin_db)
+
+    def _track_floor(self, level: float) -> None:
+        # в речи всегда есть паузы между словами, а у фона их нет: если даже
+        # минимум за окно выше текущей оценки — фон вырос, медленно поднимаемся
+        self._levels.append(level)
+        if len(self._levels) == self._levels.maxlen:
+            floor = min(self._levels)
+            if floor > self.noise_db:
+                self.noise_db += self.noise_rise * (floor - self.noise_db)
+
+    def gate(self, data) -> list:
+        """Блоки, которые надо отдать распознавателю (пусто — пропускаем)."""
+        level = block_level_db(data)
+        self._track_floor(level)
+        self.speech = self.is_speech(level)
+
+        if self.speech:
+            out = list(self._preroll) + [data]
+            self._preroll.clear()
+            self._hangover = self.hangover_blocks
+        elif self._hangover > 0:
+            self._hangover -= 1
+            out = [data]
+        else:
+            # медленно следим за фоном, только когда речи точно нет
+            self.noise_db = 0.95 * self.noise_db + 0.05 * level
+            # копия: data может быть view в кольцевой буфер микрофона
+            self._preroll.append(np.array(data, dtype=np.int16, copy=True))
+            self.skipped += 1
+            return []
+
+        self.decoded += len(out)
+        # блоки из pre-roll раньше считались пропущенными
+        self.skipped -= len(out) - 1
+        return out
+
+    def reset(self) -> None:
+        self._preroll.clear()
+        self._hangover = 0
 
-    dev = sd.default.device[0]
-    dev_info = sd.query_devices(dev, "input")
-    sr = int(dev_info["default_samplerate"]) if STT_SAMPLE_RATE is None else int(STT_SAMPLE_RATE)
 
-    _model = Model(VOSK_MODEL_PATH)
-    _rec = KaldiRecognizer(_model, sr)
+_vad = EnergyVad()
+
+
+class BargeInDetector:
+    """
+    Речь пользователя поверх TTS. Микрофон слышит и динамик, поэтому порог
+    не фиксированный: ожидаемое эхо = уровень того, что TTS играет сейчас,
+    + связь динамик->микрофон (coupling, учится на кадрах без перебивания).
+    Голос должен быть громче эха на margin_db min_frames кадров подряд.
+    Последние кадры хранятся как pre-roll — с них начнётся распознавание.
+    """
+
+    def __init__(
+        self,
+        margin_db: float = STT_BARGE_IN_MARGIN_DB,
+        min_frames: int = STT_BARGE_IN_MIN_FRAMES,
+        coupling_db: float = STT_BARGE_IN_COUPLING_DB,
+        preroll_sec: float = STT_BARGE_IN_PREROLL_SEC,
+    ):
+        self.margin_db = margin_db
+        self.min_frames = min_frames
+        self.coupling_db = coupling_db
+        self._preroll: "deque[np.ndarray]" = deque(
+            maxlen=max(min_frames, int(round(preroll_sec / STT_BARGE_IN_FRAME_SEC)))
+        )
+        self._run = 0
+        self.run_start_ts = 0.0
+        self.triggered = 0
+
+    def threshold_db(self, out_db: float) -> float:
+        return max(_vad.threshold_db, _vad.noise_db + _vad.margin_db, out_db + self.coupling_db + self.margin_db)
+
+    def update(self, frame, mic_db: float, out_db: float, now: float) -> bool:
+        """Кадр во время TTS. True — пользователь перебил."""
+        # копия: frame может быть view в кольцевой буфер микрофона
+        self._preroll.append(np.array(frame, dtype=np.int16, copy=True))
+
+        if mic_db > self.threshold_db(out_db):
+            if self._run == 0:
+                self.run_start_ts = now
+            self._run += 1
+            if self._run >= self.min_frames:
+                self.triggered += 1
+                return True
+        else:
+            self._run = 0
+            if out_db > -60.0:
+                # звучит TTS, а голоса нет — всё, что слышно, это эхо
+                coupling = min(10.0, max(-60.0, mic_db - out_db))
+                self.coupling_db = 0.9 * self.coupling_db + 0.1 * coupling
+        return False
+
+    def take_preroll(self) -> list:
+        frames = list(self._preroll)
+        self.reset()
+        return frames
+
+    def reset(self) -> None:
+        self._preroll.clear()
+        self._run = 0
+
+
+_barge = BargeInDetector()
+
+
+class Resampler:
+    """
+    Потоковый ресемплер int16: FIR-фильтр (windowed sinc) против алиасинга
+    + линейная интерполяция. Для целых коэффициентов (48k -> 16k)
+    это обычная децимация. Состояние переносится между блоками.
+    """
+
+    def __init__(self, in_rate: int, out_rate: int, taps: int = 63):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.step = in_rate / out_rate
+
+        # срез чуть ниже новой частоты Найквиста
+        self._h = lowpass_fir(0.45 * out_rate / in_rate, taps)
+
+        self._hist = np.zeros(taps - 1, dtype=np.float32)
+        self._last = np.float32(0.0)
+        self._pos = 1.0  # позиция следующего выходного сэмпла в [prev, y...]
+
+    def process(self, data) -> np.ndarray:
+        x = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        if x.size == 0:
+            return np.zeros(0, dtype=np.int16)
+
+        buf = np.concatenate((self._hist, x))
+        y = np.convolve(buf, self._h, mode="valid")
+        self._hist = buf[-(len(self._h) - 1):]
+
+        # y[0] — последний отфильтрованный сэмпл прошлого блока
+        y = np.concatenate(([self._last], y))
+        last_idx = len(y) - 1
+        positions = np.arange(self._pos, last_idx + 1e-9, self.step)
+
+        if positions.size:
+            self._pos = positions[-1] + self.step - last_idx
+        else:
+            self._pos -= last_idx
+        self._last = y[-1]
+
+        out = np.interp(positions, np.arange(len(y)), y)
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+
+def stt_stats() -> dict:
+    """Счётчики VAD: сколько блоков ушло в Vosk, сколько пропущено."""
+    total = _vad.decoded + _vad.skipped
+    stats = {
+        "decoded": _vad.decoded,
+        "skipped": _vad.skipped,
+        "skipped_ratio": (_vad.skipped / total) if total else 0.0,
+        "noise_db": round(_vad.noise_db, 1),
+        "barge_ins": _barge.triggered,
+        "echo_coupling_db": round(_barge.coupling_db, 1),
+    }
+    if _ring is not None:
+        stats.update(_ring.stats())
+    stats.update(_endpointer.stats())
+    return stats
+
+
+tracing.register_gauges("stt", stt_stats)
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = Model(VOSK_MODEL_PATH)
+    return _model
+
+
+def warm_up() -> None:
+    """Загружает модель Vosk заранее (микрофон открывается только в listen)."""
+    _get_model()
+
+
+def _pick_capture_rate(dev) -> int:
+    """
+    Если устройство умеет STT_MODEL_RATE — пишем сразу в нём (ресемплинг не нужен).
+    Иначе — его default_samplerate, а до Vosk доводим ресемплером.
+    """
+    if STT_SAMPLE_RATE is not None:
+        return int(STT_SAMPLE_RATE)
+
+    try:
+        sd.check_input_settings(device=dev, samplerate=STT_MODEL_RATE, channels=1, dtype="int16")
+        return int(STT_MODEL_RATE)
+    except Exception:
+        dev_info = sd.query_devices(dev, "input")
+        return int(dev_info["default_samplerate"])
+
+
+def _setup(sr: int) -> None:
+    """Распознаватель, кольцо и ресемплер под частоту захвата sr."""
+    global _rec, _ring, _block, _frame, _resampler, _last_voice_ts, _utt_start_ts, _best_text
+
+    # Vosk всегда работает на родной частоте модели (16 кГц у small-ru)
+    _resampler = Resampler(sr, STT_MODEL_RATE) if sr != STT_MODEL_RATE else None
+    if _resampler is not None:
+        print(f"STT: захват {sr} Гц -> ресемплинг в {STT_MODEL_RATE} Гц")
+
+    _rec = KaldiRecognizer(_get_model(), STT_MODEL_RATE)
     _rec.SetWords(False)
 
     _last_voice_ts = time.time()
     _utt_start_ts = time.time()
     _best_text = ""
 
+    _block = int(sr * STT_BLOCK_SEC)
+    _frame = max(1, int(sr * STT_BARGE_IN_FRAME_SEC))
+    _ring = PcmRingBuffer(int(sr * STT_RING_SEC))
+
+
+def _init():
+    global _stream
+    if _ring is not None:
+        return
+
+    if STT_DEVICE_INDEX is not None:
+        sd.default.device = (STT_DEVICE_INDEX, None)
+
+    dev = sd.default.device[0]
+    sr = _pick_capture_rate(dev)
+    _setup(sr)
+
     def callback(indata, frames, time_info, status):
-        _q.put(bytes(indata))
+        # без аллокаций: просто копия сэмплов в заранее выделенное кольцо
+        _ring.write(indata)
 
     _stream = sd.RawInputStream(
         samplerate=sr,
-        blocksize=int(sr * STT_BLOCK_SEC),
+        blocksize=_block,
         dtype="int16",
         channels=1,
         callback=callback,
@@ -59,81 +349,241 @@ def _init():
     _stream.start()
 
 
-def _flush_queue():
-    try:
-        while True:
-            _q.get_nowait()
-    except queue.Empty:
-        pass
+def open_virtual_input(sample_rate: int) -> PcmRingBuffer:
+    """
+    Вход без микрофона (бенчмарк, воспроизведение записей): listen()
+    читает то, что пишут в возвращённое кольцо, как будто это колбэк
+    звуковой карты. Вызывать до первого listen().
+    """
+    if _ring is not None:
+        raise RuntimeError("STT already initialized")
+    _setup(sample_rate)
+    return _ring
+
+
+def block_samples() -> int:
+    """Размер блока в сэмплах на частоте захвата (после _init/open_virtual_input)."""
+    return _block
+
+
+def _flush_audio():
+    _ring.flush()
 
 
 def _reset_utt():
-    global _best_text, _utt_start_ts
+    global _best_text, _utt_start_ts, _stable_blocks, _reported_partial, _barge_in
     _best_text = ""
+    _barge_in = False
+    _stable_blocks = 0
+    _reported_partial = ""
     _utt_start_ts = time.time()
     _rec.Reset()
+    _vad.reset()
 
 
-def listen(timeout_sec: float = 0.15) -> str | None:
-    """
-    Возвращает фразу ТОЛЬКО когда наступила пауза STT_SILENCE_TIMEOUT.
-    Это убирает ранние "обрывки".
-    """
-    global _last_voice_ts, _best_text
+def _voice(now: float, in_utterance: bool) -> None:
+    """Отметка "пользователь говорит" — для эндпоинтера и таймера тишины."""
+    global _last_voice_ts
+    _endpointer.on_voice(now, _last_voice_ts, in_utterance, STT_BLOCK_SEC)
+    _last_voice_ts = now
 
-    _init()
 
-    if tts.is_speaking:
-        _flush_queue()
-        _reset_utt()
-        time.sleep(0.05)
-        return None
-
-    start = time.time()
-    got_audio = False
-
-    while (time.time() - start) < timeout_sec:
-        try:
-            data = _q.get_nowait()
-            got_audio = True
-        except queue.Empty:
-            break
-
-        # Даже если Vosk считает waveform "final", мы не возвращаем сразу.
-        # Мы просто обновим _best_text.
-        if _rec.AcceptWaveform(data):
-            res = json.loads(_rec.Result() or "{}")
-            txt = (res.get("text") or "").strip()
-            if txt:
-                _best_text = txt
-                _last_voice_ts = time.time()
-        else:
-            pres = json.loads(_rec.PartialResult() or "{}")
-            part = (pres.get("partial") or "").strip()
-            if part:
-                _best_text = part  # partial часто "свежее" и длиннее
-                _last_voice_ts = time.time()
+def _set_text(txt: str) -> None:
+    global _best_text, _utt_start_ts, _stable_blocks, _text_changed_ts
+    if not txt or txt == _best_text:
+        _stable_blocks += 1
+        return
 
-    now = time.time()
+    in_utterance = bool(_best_text)
+    if not in_utterance:
+        # отсчёт STT_MAX_UTTERANCE_SEC — от начала речи, а не от прошлого сброса
+        _utt_start_ts = time.time()
+    _best_text = txt
+    _stable_blocks = 0
+    _text_changed_ts = time.time()
+    _voice(_text_changed_ts, in_utterance)
+
+
+def _accept(data) -> None:
+    """Скармливает блок Vosk и обновляет _best_text."""
+    # Даже если Vosk считает waveform "final", мы не возвращаем сразу.
+    # Мы просто обновим _best_text.
+    if _rec.AcceptWaveform(bytes(data)):
+        res = json.loads(_rec.Result() or "{}")
+        _set_text((res.get("text") or "").strip())
+    else:
+        pres = json.loads(_rec.PartialResult() or "{}")
+        # partial часто "свежее" и длиннее
+        _set_text((pres.get("partial") or "").strip())
+
+
+def _endpoint_at() -> float:
+    """Момент, когда фраза будет считаться законченной, если речи больше не будет."""
+    silence_end = _last_voice_ts + _endpointer.timeout(_best_text, _stable_blocks)
+    return min(silence_end, _utt_start_ts + STT_MAX_UTTERANCE_SEC)
 
+
+def _worth_returning(text: str) -> bool:
+    """Фраза годится: хватает слов или это короткая законченная команда ("да", "выход")."""
+    words = text.lower().split()
+    if len(words) >= STT_MIN_WORDS:
+        return True
+    phrase = " ".join(words)
+    return bool(phrase) and (phrase in COMPLETE_PHRASES or phrase in EXIT_WORDS)
+
+
+def _endpoint(now: float) -> str | None:
+    """
+    Проверяет конец фразы. Возвращает текст, если фраза закончилась и годится.
+    """
     # защита от "говорю слишком долго" — режем по максимуму
     if (now - _utt_start_ts) > STT_MAX_UTTERANCE_SEC and _best_text:
         text = _best_text.strip()
         _reset_utt()
-        if len(text.split()) >= STT_MIN_WORDS:
-            return text
-        return None
+        return text if _worth_returning(text) else None
 
-    # финалим только по тишине
-    if _best_text and (now - _last_voice_ts) >= STT_SILENCE_TIMEOUT:
+    # финалим по тишине; её длину выбирает эндпоинтер
+    if _best_text and now >= _endpoint_at():
         # добьём финалом
-        fres = json.loads(_rec.FinalResult() or "{}")
+        tracing.observe("stt.endpoint_delay", now - _last_voice_ts)
+        with tracing.span("stt.finalize"):
+            fres = json.loads(_rec.FinalResult() or "{}")
         final_txt = (fres.get("text") or "").strip()
         text = (final_txt or _best_text).strip()
 
+        if not _worth_returning(text):
+            # обрывок/шум: в статистику эндпоинтера не идёт
+            _reset_utt()
+            return None
+
+        _endpointer.on_endpoint(now, _last_voice_ts)
         _reset_utt()
+        return text
+
+    return None
 
-        if len(text.split()) >= STT_MIN_WORDS:
+
+def _check_stable_partial(now: float, on_partial) -> None:
+    """Отдаёт partial в on_partial, когда он не менялся STT_SPECULATE_STABLE_SEC."""
+    global _reported_partial
+    if on_partial is None or not _best_text or _best_text == _reported_partial:
+        return
+    if now - _text_changed_ts >= STT_SPECULATE_STABLE_SEC:
+        _reported_partial = _best_text
+        on_partial(_best_text)
+
+
+def _listen_during_tts(data, on_barge_in) -> None:
+    """
+    Кадр микрофона, пока говорит TTS. В Vosk не идёт (там эхо), только
+    в детектор; при перебивании TTS глушится сразу здесь, в потоке STT,
+    а распознавание стартует с pre-roll.
+    """
+    global _barge_in
+    now = time.time()
+    if not _barge.update(data, block_level_db(data), tts.playback_level_db(), now):
+        return
+
+    tts.interrupt()
+    tracing.observe("stt.barge_in", time.time() - _barge.run_start_ts)
+    frames = _barge.take_preroll()
+
+    _reset_utt()
+    _barge_in = True
+    _voice(now, False)
+    for frame in frames:
+        _accept(frame)
+
+    if on_barge_in is not None:
+        on_barge_in()
+
+
+def in_phrase() -> bool:
+    """Пользователь сейчас говорит (фраза начата, но ещё не закончена)."""
+    return bool(_best_text)
+
+
+def listen(timeout_sec: float | None = None, on_partial=None, on_barge_in=None) -> str | None:
+    """
+    Блокирует, пока не будет готова фраза (пауза выбирается эндпоинтером),
+    или пока не выйдет timeout_sec (None = ждать бесконечно).
+    Просыпается только на новый блок аудио или на момент конца фразы —
+    никакого поллинга. Если фраза уже начата, таймаут не обрывает её.
+
+    on_partial(text) вызывается, когда partial стабилен STT_SPECULATE_STABLE_SEC
+    (для спекулятивной генерации ответа до конца фразы).
+
+    С STT_BARGE_IN микрофон слушается и во время TTS: речь пользователя
+    обрывает воспроизведение, и вызывается on_barge_in() — отменить ответ.
+    """
+    global _barge_in
+    _init()
+
+    deadline = None if timeout_sec is None else time.time() + timeout_sec
+
+    while True:
+        now = time.time()
+
+        if _barge_in and not tts.is_speaking:
+            # перебитый ответ затих — дальше обычный режим
+            _barge_in = False
+
+        if tts.is_speaking and STT_BARGE_IN and not _barge_in:
+            # слушаем поверх TTS мелкими кадрами, Vosk пока не трогаем
+            wait = None if deadline is None else max(0.0, deadline - now)
+            if _ring.wait(_frame, wait):
+                data = _ring.read(_frame)
+                if _resampler is not None:
+                    data = _resampler.process(data)
+                _listen_during_tts(data, on_barge_in)
+            if not _barge_in and deadline is not None and time.time() >= deadline:
+                return None
+            continue
+
+        if tts.is_speaking and not STT_BARGE_IN:
+            # пока говорит TTS — микрофон не слушаем, просто ждём тишины
+            _flush_audio()
+            _reset_utt()
+            wait = None if deadline is None else max(0.0, deadline - now)
+            if not tts.wait_idle(wait):
+                return None
+            _flush_audio()
+            continue
+
+        # сколько можно спать: до конца фразы по тишине или до таймаута
+        if _best_text:
+            wake_at = _endpoint_at()
+            if on_partial is not None and _best_text != _reported_partial:
+                wake_at = min(wake_at, _text_changed_ts + STT_SPECULATE_STABLE_SEC)
+            wait = max(0.0, wake_at - now)
+        elif deadline is not None:
+            if now >= deadline:
+                return None
+            wait = deadline - now
+        else:
+            wait = None
+
+        data = _ring.read(_block) if _ring.wait(_block, wait) else None
+
+        if data is not None:
+            if _resampler is not None:
+                data = _resampler.process(data)
+            blocks = _vad.gate(data) if STT_VAD_ENABLED else [data]
+            if STT_VAD_ENABLED and _vad.speech:
+                _voice(time.time(), bool(_best_text))
+            for block in blocks:
+                _accept(block)
+
+        _check_stable_partial(time.time(), on_partial)
+
+        text = _endpoint(time.time())
+        if text:
             return text
 
-    return None
\ No newline at end of file
+
+def utterances():
+    """Бесконечный генератор распознанных фраз."""
+    while True:
+        text = listen()
+        if text:
+            yield text
@@ -0,0 +1,38 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# последние замеры прогрева: имя подсистемы -> секунды
+timings: dict[str, float] = {}
+
+
+def _timed(name: str, fn) -> float:
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        fn()
+    except Exception as e:
+        status = f"error: {repr(e)}"
+    dt = time.perf_counter() - t0
+    timings[name] = dt
+    print(f"Startup: {name:<10} {dt * 1000:7.0f} ms  {status}")
+    return dt
+
+
+def warm_up_parallel(tasks: dict, wait_for=None) -> float:
+    """
+    Запускает прогрев подсистем параллельно и ждёт только те, что в wait_for
+    (по умолчанию все). Остальные догружаются в фоне и печатают время сами.
+    Возвращает время ожидания — это и есть холодный старт.
+    """
+    t0 = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=max(1, len(tasks)), thread_name_prefix="warmup")
+    futures = {name: pool.submit(_timed, name, fn) for name, fn in tasks.items()}
+
+    for name in (tasks if wait_for is None else wait_for):
+        futures[name].result()
+
+    pool.shutdown(wait=False)
+    total = time.perf_counter() - t0
+    print(f"Startup: готово за {total * 1000:.0f} ms (сумма по подсистемам: "
+          f"{sum(timings.get(n, 0.0) for n in futures) * 1000:.0f} ms)")
+    return total
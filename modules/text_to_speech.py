@@ -1,52 +1,199 @@
-from config import FFMPEG_PATH, PITCH_SEMITONES
+from config import (
+    PITCH_SEMITONES,
+    TTS_STREAM_CLAUSE_CHARS,
+    TTS_AUDIO_BUFFER,
+    TTS_CACHE_DIR,
+    TTS_CACHE_MAX_MB,
+    TTS_CACHE_MAX_CHARS,
+)
+import atexit
+import functools
+import json
 import os
+import re
 import subprocess
-import tempfile
 import threading
-import queue
 import time
+import queue
+import numpy as np
 import simpleaudio as sa
 
+from modules import tracing
+from modules.dsp import lowpass_fir
+from modules.tts_cache import PcmCache
+
 # Путь к модели Piper (поправь под себя)
 PIPER_MODEL_PATH = os.path.join("models", "piper", "ru_RU-irina-medium.onnx")
 
-_q: "queue.Queue[str | None]" = queue.Queue()
+# элементы очередей — (поколение, данные, on_played); None — остановка воркеров
+_q: "queue.Queue[tuple[int, str, object] | None]" = queue.Queue()
+# готовый PCM между стадиями синтеза и воспроизведения
+_audio_q: "queue.Queue[tuple[int, np.ndarray, object] | None]" = queue.Queue(maxsize=TTS_AUDIO_BUFFER)
+# clear() увеличивает поколение: всё, что поставлено раньше, воркеры выкидывают
+_generation = 0
+
+# фразы, поставленные в очередь, но ещё не доигранные
+_pending = 0
+_pending_lock = threading.Lock()
 is_speaking = False
+# выставлен, когда говорить нечего — на нём можно ждать вместо sleep-поллинга
+_idle_event = threading.Event()
+_idle_event.set()
+
+# конец предложения: .!?… (можно с кавычкой/скобкой) и пробел после —
+# пробел нужен, чтобы не резать "3.5" или "т.е" посреди стрима
+_SENTENCE_END = re.compile(r'[.!?…]+["»)]*\s+')
+# конец клаузы: режем только если накопилось достаточно текста
+_CLAUSE_END = re.compile(r'[,;:—]\s+')
+
+def _load_voice():
+    """
+    Загружает голос Piper один раз и держит его в памяти.
+    Если python-пакета piper нет — вернёт None, и синтез пойдёт через piper CLI.
+    """
+    if not os.path.exists(PIPER_MODEL_PATH):
+        print(f"TTS: Piper model not found: {PIPER_MODEL_PATH}")
+        return None
+
+    try:
+        from piper.voice import PiperVoice
+    except ImportError:
+        print("TTS: python-пакет piper не найден, использую piper CLI")
+        return None
+
+    return PiperVoice.load(PIPER_MODEL_PATH)
+
+
+def _model_sample_rate() -> int:
+    with open(PIPER_MODEL_PATH + ".json", encoding="utf-8") as f:
+        return int(json.load(f)["audio"]["sample_rate"])
+
+
+# голос грузится один раз: при первой фразе или заранее через warm_up()
+_voice = None
+_voice_loaded = False
+_voice_lock = threading.Lock()
+_sample_rate = 22050
+
+
+def _get_voice():
+    global _voice, _voice_loaded, _sample_rate
+    if not _voice_loaded:
+        with _voice_lock:
+            if not _voice_loaded:
+                _voice = _load_voice()
+                _sample_rate = _voice.config.sample_rate if _voice is not None else _model_sample_rate()
+                _voice_loaded = True
+    return _voice
+
+
+def warm_up() -> None:
+    _get_voice()
+    _get_cache()
+
+
+_cache: PcmCache | None = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+
+def _get_cache() -> PcmCache | None:
+    global _cache, _cache_loaded
+    if not _cache_loaded:
+        with _cache_lock:
+            if not _cache_loaded:
+                if TTS_CACHE_DIR:
+                    try:
+                        _cache = PcmCache(TTS_CACHE_DIR, int(TTS_CACHE_MAX_MB * 1024 * 1024))
+                        # иначе порядок LRU после одних попаданий не доживёт до рестарта
+                        atexit.register(_cache.close)
+                    except OSError as e:
+                        print("TTS cache disabled:", e)
+                _cache_loaded = True
+    return _cache
+
+
+def _voice_id() -> str:
+    # переобученный/заменённый файл голоса — другой ключ
+    try:
+        st = os.stat(PIPER_MODEL_PATH)
+        return f"{os.path.basename(PIPER_MODEL_PATH)}:{st.st_size}:{int(st.st_mtime)}"
+    except OSError:
+        return os.path.basename(PIPER_MODEL_PATH)
+
+
+def cache_stats() -> dict:
+    cache = _get_cache()
+    return cache.stats() if cache is not None else {}
+
 
-def _pitch_shift(input_wav: str, output_wav: str, semitones: float = None):
-    import subprocess, os
+# для метрик — без ленивого создания кэша
+tracing.register_gauges("tts_cache", lambda: _cache.stats() if _cache is not None else {})
+
+
+def _pitch_shift(pcm: np.ndarray, semitones: float = None) -> np.ndarray:
+    """
+    Аналог ffmpeg "asetrate=sr*factor,aresample=sr", но прямо на буфере:
+    ресемплинг в 1/factor раз по длине (голос выше и чуть быстрее).
+    При сдвиге вверх это децимация — сначала срезаем всё выше новой
+    частоты Найквиста, иначе шипящие заворачиваются в слышимый алиасинг.
+    """
     if semitones is None:
         semitones = PITCH_SEMITONES
 
-    if not os.path.exists(FFMPEG_PATH):
-        raise FileNotFoundError(f"ffmpeg not found at: {FFMPEG_PATH}")
-
     factor = 2 ** (semitones / 12)
-    subprocess.run([
-        FFMPEG_PATH,
-        "-y",
-        "-i", input_wav,
-        "-filter:a", f"asetrate=22050*{factor},aresample=22050",
-        output_wav
-    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    n_out = int(len(pcm) / factor)
+    if n_out <= 0:
+        return pcm
+
+    x = pcm.astype(np.float32)
+    if factor > 1.0:
+        x = np.convolve(x, lowpass_fir(0.45 / factor), mode="same")
+
+    src_pos = np.arange(n_out, dtype=np.float64) * factor
+    out = np.interp(src_pos, np.arange(len(x)), x)
+    return np.clip(np.round(out), -32768, 32767).astype(np.int16)
 
 
-def _play_wav(path: str) -> None:
-    wave = sa.WaveObject.from_wave_file(path)
-    play = wave.play()
-    play.wait_done()
+# что играет сейчас: объект simpleaudio (для stop()) и (pcm, sr, начало) для уровня эха
+_play_obj = None
+_playing: tuple[np.ndarray, int, float] | None = None
+# interrupt() будит sink, который «играет» без simpleaudio (null_sink)
+_interrupt_event = threading.Event()
 
 
-def _synth_piper_to_wav(text: str, out_wav: str) -> None:
+def _play_pcm(pcm: np.ndarray, sample_rate: int) -> None:
+    # pcm из кэша — np.memmap: simpleaudio читает его прямо из страниц файла
+    global _play_obj
+    _play_obj = sa.play_buffer(np.ascontiguousarray(pcm), 1, 2, sample_rate)
+    _play_obj.wait_done()
+
+
+_sink = _play_pcm
+
+
+def set_sink(sink=None) -> None:
     """
-    Генерация WAV через piper CLI.
-    ВАЖНО: input должен быть bytes (utf-8), иначе ловишь Unicode/TypeError.
+    Куда отдавать готовый PCM: sink(pcm, sample_rate), блокирует на время
+    «воспроизведения». None — обратно на динамики. Для бенчмарка и
+    прогонов без звука.
     """
-    if not os.path.exists(PIPER_MODEL_PATH):
-        raise FileNotFoundError(f"Piper model not found: {PIPER_MODEL_PATH}")
+    global _sink
+    _sink = sink or _play_pcm
+
 
+def null_sink(pcm: np.ndarray, sample_rate: int) -> None:
+    """Sink без звука: держит очередь ровно столько, сколько длится фраза."""
+    _interrupt_event.wait(len(pcm) / float(sample_rate))
+
+
+def _synth_piper_cli(text: str) -> bytes:
+    """
+    Запасной путь: piper CLI с --output_raw (PCM в stdout, без временных файлов).
+    ВАЖНО: input должен быть bytes (utf-8), иначе ловишь Unicode/TypeError.
+    """
     r = subprocess.run(
-        ["piper", "--model", PIPER_MODEL_PATH, "--output_file", out_wav],
+        ["piper", "--model", PIPER_MODEL_PATH, "--output_raw"],
         input=(text.strip() + "\n").encode("utf-8"),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -54,61 +201,258 @@ def _synth_piper_to_wav(text: str, out_wav: str) -> None:
     if r.returncode != 0:
         err = r.stderr.decode("utf-8", errors="replace")
         raise RuntimeError(f"Piper failed: {err[:500]}")
+    return r.stdout
 
 
-def _worker() -> None:
-    global is_speaking
+def _synth_pcm(text: str) -> np.ndarray:
+    """
+    Синтез в int16 PCM (моно, _sample_rate) резидентным голосом.
+    """
+    voice = _get_voice()
+    if voice is None:
+        raw = _synth_piper_cli(text)
+    elif hasattr(voice, "synthesize_stream_raw"):
+        # piper-tts 1.2.x
+        raw = b"".join(voice.synthesize_stream_raw(text))
+    else:
+        # piper-tts >= 1.3: synthesize() отдаёт AudioChunk'и
+        raw = b"".join(chunk.audio_int16_bytes for chunk in voice.synthesize(text))
+
+    return np.frombuffer(raw, dtype=np.int16)
+
+
+def _finish_item() -> None:
+    """Фраза полностью обработана (сыграна или упала с ошибкой)."""
+    global _pending, is_speaking
+    with _pending_lock:
+        _pending -= 1
+        is_speaking = _pending > 0
+        if not is_speaking:
+            _idle_event.set()
+    _q.task_done()
+
+
+def _synth_worker() -> None:
+    """
+    Стадия 1: текст -> PCM. Пока играет фраза N, здесь уже готовится N+1.
+    """
     while True:
-        text = _q.get()
-        if text is None:
+        item = _q.get()
+        if item is None:
+            _audio_q.put(None)
             _q.task_done()
             break
 
-        wav_path = None
+        gen, text, on_played = item
+        if gen != _generation:
+            _finish_item()
+            continue
+
         try:
-            is_speaking = True
             text = str(text).strip()
             if not text:
+                _finish_item()
                 continue
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
-                wav_path = f.name
-
-            _synth_piper_to_wav(text, wav_path)
+            cache = _get_cache() if len(text) <= TTS_CACHE_MAX_CHARS else None
+            key = None
+            pcm = None
+            if cache is not None:
+                _get_voice()  # _sample_rate входит в ключ
+                key = cache.key(text, _voice_id(), PITCH_SEMITONES, _sample_rate)
+                with tracing.span("tts.cache"):
+                    pcm = cache.get(key)
 
-            pitched_path = wav_path.replace(".wav", "_pitch.wav")
-            _pitch_shift(wav_path, pitched_path, semitones=2.5)
-
-            _play_wav(pitched_path)
+            if pcm is None:
+                with tracing.span("tts.synth", chars=len(text)):
+                    pcm = _synth_pcm(text)
+                with tracing.span("tts.pitch"):
+                    pcm = _pitch_shift(pcm)
+                if key is not None:
+                    cache.put(key, pcm)
 
         except Exception as e:
             print("TTS exception:", repr(e))
+            _finish_item()
+            continue
+
+        if gen != _generation:
+            # пока синтезировали, ответ отменили
+            _finish_item()
+            continue
+
+        # блокируется, если буфер полон — синтез не убегает далеко вперёд
+        _audio_q.put((gen, pcm, on_played))
+
+
+def _play_worker() -> None:
+    """
+    Стадия 2: воспроизведение готовых буферов подряд, без пауз на синтез.
+    """
+    global _playing
+    while True:
+        item = _audio_q.get()
+        if item is None:
+            break
+
+        gen, pcm, on_played = item
+        if gen != _generation:
+            _finish_item()
+            continue
 
+        _interrupt_event.clear()
+        _playing = (pcm, _sample_rate, time.time())
+        try:
+            with tracing.span("tts.play", audio_sec=round(len(pcm) / _sample_rate, 2)):
+                _sink(pcm, _sample_rate)
+            # interrupt() оборвал фразу — пользователь её не дослушал
+            if on_played is not None and not _interrupt_event.is_set():
+                on_played()
+        except Exception as e:
+            print("TTS playback exception:", repr(e))
         finally:
-            is_speaking = False
-            _q.task_done()
-            if wav_path and os.path.exists(wav_path):
-                try:
-                    os.remove(wav_path)
-                except Exception:
-                    pass
-            time.sleep(0.02)
+            _playing = None
+            _finish_item()
+
+
+_workers_started = False
+_workers_lock = threading.Lock()
+
+
+def _ensure_workers() -> None:
+    global _workers_started
+    with _workers_lock:
+        if not _workers_started:
+            threading.Thread(target=_synth_worker, daemon=False).start()
+            threading.Thread(target=_play_worker, daemon=False).start()
+            _workers_started = True
 
 
-threading.Thread(target=_worker, daemon=False).start()
+def speak(text: str, on_played=None) -> None:
+    """
+    Ставит фразу в очередь. on_played() вызывается из потока воспроизведения,
+    когда фраза доиграна целиком (не отменена и не оборвана перебиванием).
+    """
+    _enqueue(text, on_played, _generation)
 
 
-def speak(text: str) -> None:
+def _enqueue(text: str, on_played, generation: int) -> None:
+    global _pending, is_speaking
     if text:
-        _q.put(text)
+        _ensure_workers()
+        with _pending_lock:
+            _pending += 1
+            is_speaking = True
+            _idle_event.clear()
+        _q.put((generation, text, on_played))
 
 
 def speak_blocking(text: str) -> None:
     if not text:
         return
-    _q.put(text)
+    speak(text)
     _q.join()
 
 
+def wait_idle(timeout: float | None = None) -> bool:
+    """Ждёт, пока TTS договорит. False — если вышел таймаут."""
+    return _idle_event.wait(timeout)
+
+
+def clear() -> None:
+    """
+    Отменяет всё, что ещё не начало звучать (текущая фраза доигрывает):
+    воркеры выкидывают фразы старого поколения без синтеза и воспроизведения.
+    """
+    global _generation
+    _generation += 1
+
+
+def interrupt() -> None:
+    """
+    Barge-in: сразу глушит текущую фразу и выкидывает всё, что стоит в очереди.
+    """
+    clear()
+    _interrupt_event.set()
+    play = _play_obj
+    if play is not None and play.is_playing():
+        play.stop()
+
+
+def playback_level_db(window_sec: float = 0.15) -> float:
+    """
+    Уровень (dBFS) того, что TTS играет прямо сейчас, по последним window_sec —
+    по нему STT отличает эхо динамика от голоса. -120, если ничего не играет.
+    """
+    playing = _playing
+    if playing is None:
+        return -120.0
+    pcm, sr, t0 = playing
+    end = min(len(pcm), int((time.time() - t0) * sr))
+    start = max(0, end - int(window_sec * sr))
+    if end <= start:
+        return -120.0
+    x = pcm[start:end].astype(np.float32)
+    rms = np.sqrt(np.mean(x * x)) / 32768.0
+    return float(20.0 * np.log10(rms + 1e-10))
+
+
 def stop_tts() -> None:
-    _q.put(None)
\ No newline at end of file
+    if _workers_started:
+        _q.put(None)
+
+
+def split_ready(buf: str) -> tuple[list[str], str]:
+    """
+    Отрезает от buf все законченные предложения/клаузы.
+    Возвращает (готовые куски, остаток).
+    """
+    chunks = []
+    while True:
+        m = _SENTENCE_END.search(buf)
+        if m is None and len(buf) >= TTS_STREAM_CLAUSE_CHARS:
+            # длинное предложение без точки — отдаём по последней запятой
+            for m in _CLAUSE_END.finditer(buf):
+                pass
+        if m is None:
+            break
+
+        chunk = buf[:m.end()].strip()
+        buf = buf[m.end():]
+        if chunk:
+            chunks.append(chunk)
+    return chunks, buf
+
+
+def speak_stream(tokens, on_played=None, cancel=None) -> str:
+    """
+    Озвучивает поток токенов LLM: каждое законченное предложение
+    сразу уходит в очередь TTS, не дожидаясь конца ответа.
+    Возвращает полный текст ответа (прочитанную часть, если стрим отменён).
+
+    on_played(фраза) — фраза доиграна целиком (см. speak). cancel
+    (threading.Event) прекращает чтение токенов. Фразы стрима привязаны
+    к поколению, в котором он начался: после clear()/interrupt() даже
+    фраза, поставленная в гонке с отменой, не прозвучит.
+    """
+    generation = _generation
+    parts = []
+    buf = ""
+
+    def say(chunk: str) -> None:
+        played = functools.partial(on_played, chunk) if on_played is not None else None
+        _enqueue(chunk, played, generation)
+
+    for token in tokens:
+        if cancel is not None and cancel.is_set():
+            break
+        parts.append(token)
+        buf += token
+
+        chunks, buf = split_ready(buf)
+        for chunk in chunks:
+            say(chunk)
+
+    if cancel is None or not cancel.is_set():
+        say(buf.strip())
+    return "".join(parts)
@@ -0,0 +1,275 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+from config import (
+    TRACE_ENABLED,
+    TRACE_JSONL_PATH,
+    TRACE_JSONL_MAX_BYTES,
+    TRACE_JSONL_BACKUPS,
+    TRACE_PROM_PATH,
+    TRACE_EXPORT_INTERVAL_SEC,
+    TRACE_BUCKETS_MS,
+)
+
+# Спаны стадий хода: в горячем пути только perf_counter и гистограмма,
+# диск (JSONL и файл для Prometheus) — в фоновом потоке раз в N секунд.
+# Выключенная трассировка стоит один if: span() отдаёт общий пустой спан.
+
+_enabled = TRACE_ENABLED
+_turn = 0
+_lock = threading.Lock()
+_bounds = [ms / 1000.0 for ms in TRACE_BUCKETS_MS]
+_histograms: dict[str, "Histogram"] = {}
+_pending: deque = deque(maxlen=10000)   # спаны, ещё не записанные в JSONL
+_gauges: dict[str, object] = {}          # компонент -> fn() со счётчиками
+
+_exporter_started = False
+
+
+class Histogram:
+    """Счётчики по корзинам (секунды, le) + сумма, количество и ошибки."""
+
+    def __init__(self, bounds: list[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, sec: float, error: bool = False) -> None:
+        self.counts[bisect_left(self.bounds, sec)] += 1
+        self.sum += sec
+        self.count += 1
+        if error:
+            self.errors += 1
+
+
+def set_enabled(on: bool) -> None:
+    """Включает/выключает трассировку на лету (уже открытые спаны досчитаются)."""
+    global _enabled
+    _enabled = bool(on)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def new_turn() -> int:
+    """Начало хода: следующие спаны помечаются этим номером."""
+    global _turn
+    _turn += 1
+    return _turn
+
+
+def _record(name: str, sec: float, error: bool, turn: int, attrs: dict) -> None:
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram(_bounds)
+        hist.observe(sec, error)
+        if TRACE_JSONL_PATH:
+            rec = {"ts": round(time.time(), 3), "turn": turn, "span": name, "ms": round(sec * 1000.0, 2)}
+            if error:
+                rec["error"] = True
+            if attrs:
+                rec.update(attrs)
+            _pending.append(rec)
+    _ensure_exporter()
+
+
+class _Span:
+    __slots__ = ("name", "attrs", "turn", "t0")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.turn = _turn
+
+    def set(self, **attrs) -> None:
+        """Доп. поля для JSONL (размеры, модель, попадание в кэш...)."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _record(self.name, time.perf_counter() - self.t0, exc_type is not None, self.turn, self.attrs)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **attrs):
+    """
+    with tracing.span("memory.search", limit=4): ...
+    Время уходит в гистограмму name, сам спан — в JSONL.
+    """
+    if not _enabled:
+        return _NOOP
+    return _Span(name, attrs)
+
+
+def observe(name: str, sec: float, error: bool = False, **attrs) -> None:
+    """Готовое измерение (когда начало и конец в разных местах, например первый токен стрима)."""
+    if _enabled:
+        _record(name, sec, error, _turn, attrs)
+
+
+def traced(name: str):
+    """Декоратор: весь вызов функции — один спан."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(name, {}):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def register_gauges(component: str, fn) -> None:
+    """
+    Счётчики компонента (VAD/эндпоинтер, кэши, спекуляция): fn() -> {имя: число}.
+    Снимаются при каждом экспорте метрик и в gauges(), в горячем пути не стоят.
+    """
+    _gauges[component] = fn
+
+
+def gauges() -> dict[str, dict]:
+    """Текущие значения всех зарегистрированных счётчиков (только числа)."""
+    out = {}
+    for component, fn in list(_gauges.items()):
+        try:
+            values = fn() or {}
+        except Exception as e:
+            print(f"Gauge {component} error:", repr(e))
+            continue
+        out[component] = {k: v for k, v in values.items() if isinstance(v, (int, float))}
+    return out
+
+
+# ---------- экспорт ----------
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def prometheus_text() -> str:
+    """Гистограммы в текстовом формате Prometheus (для node_exporter textfile)."""
+    with _lock:
+        snapshot = {
+            name: (list(h.counts), h.sum, h.count, h.errors)
+            for name, h in sorted(_histograms.items())
+        }
+
+    lines = [
+        "# HELP jarvis_stage_seconds Duration of assistant pipeline stages.",
+        "# TYPE jarvis_stage_seconds histogram",
+    ]
+    for name, (counts, total, count, _) in snapshot.items():
+        stage = _label(name)
+        cumulative = 0
+        for bound, n in zip(_bounds, counts):
+            cumulative += n
+            lines.append(f'jarvis_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+        lines.append(f'jarvis_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'jarvis_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'jarvis_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    lines.append("# HELP jarvis_stage_errors_total Stages that ended with an exception.")
+    lines.append("# TYPE jarvis_stage_errors_total counter")
+    for name, (_, _, _, errors) in snapshot.items():
+        lines.append(f'jarvis_stage_errors_total{{stage="{_label(name)}"}} {errors}')
+
+    lines.append("# HELP jarvis_stat Component counters (endpointer, VAD, caches, speculation).")
+    lines.append("# TYPE jarvis_stat gauge")
+    for component, values in sorted(gauges().items()):
+        for key, value in sorted(values.items()):
+            lines.append(f'jarvis_stat{{component="{_label(component)}",name="{_label(key)}"}} {float(value):g}')
+    return "\n".join(lines) + "\n"
+
+
+def _rotate(path: str) -> None:
+    if not os.path.exists(path) or os.path.getsize(path) < TRACE_JSONL_MAX_BYTES:
+        return
+    if TRACE_JSONL_BACKUPS <= 0:
+        os.remove(path)
+        return
+    for i in range(TRACE_JSONL_BACKUPS - 1, 0, -1):
+        src = f"{path}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{path}.{i + 1}")
+    os.replace(path, f"{path}.1")
+
+
+def flush() -> None:
+    """Дописывает накопленные спаны в JSONL и перезаписывает файл метрик."""
+    with _lock:
+        records = list(_pending)
+        _pending.clear()
+
+    try:
+        if TRACE_JSONL_PATH and records:
+            os.makedirs(os.path.dirname(TRACE_JSONL_PATH) or ".", exist_ok=True)
+            _rotate(TRACE_JSONL_PATH)
+            with open(TRACE_JSONL_PATH, "a", encoding="utf-8") as f:
+                for rec in records:
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+        if TRACE_PROM_PATH and _histograms:
+            # атомарная замена: скрейпер не увидит полузаписанный файл
+            tmp = TRACE_PROM_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(prometheus_text())
+            os.replace(tmp, TRACE_PROM_PATH)
+    except Exception as e:
+        print("Trace export error:", repr(e))
+
+
+def reset() -> None:
+    """Забывает гистограммы и незаписанные спаны (бенчмарк после своего flush)."""
+    with _lock:
+        _histograms.clear()
+        _pending.clear()
+
+
+def _exporter() -> None:
+    while True:
+        time.sleep(TRACE_EXPORT_INTERVAL_SEC)
+        flush()
+
+
+def _ensure_exporter() -> None:
+    global _exporter_started
+    if _exporter_started:
+        return
+    with _lock:
+        if _exporter_started:
+            return
+        threading.Thread(target=_exporter, daemon=True).start()
+        _exporter_started = True
+
+
+atexit.register(flush)
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_phrase(text: str) -> str:
+    # регистр и пунктуация меняют интонацию Piper — схлопываем только пробелы
+    return " ".join(text.split())
+
+
+class PcmCache:
+    """
+    Дисковый LRU-кэш готового PCM (int16, уже с pitch). Ключ — blake2b от
+    нормализованного текста, голоса, сдвига тона и частоты, так что смена
+    любого из них не отдаст старый звук. Каждая фраза — отдельный .pcm,
+    читается через np.memmap (без копии и без декодирования). Порядок LRU
+    и размеры — в index.json; при превышении max_bytes удаляются самые
+    давно звучавшие фразы. put() пишет индекс сразу, а попадания get()
+    только двигают порядок в памяти — на диск его сбрасывает close().
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index_path = os.path.join(path, "index.json")
+        self._items: "OrderedDict[str, int]" = OrderedDict()   # ключ -> байт
+        self._bytes = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(text: str, voice_id: str, semitones: float, sample_rate: int) -> str:
+        raw = f"{voice_id}\0{semitones:g}\0{sample_rate}\0{normalize_phrase(text)}".encode("utf-8")
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def _file(self, k: str) -> str:
+        return os.path.join(self.path, k + ".pcm")
+
+    def get(self, k: str) -> np.ndarray | None:
+        with self._lock:
+            if k not in self._items:
+                self.misses += 1
+                return None
+            self._items.move_to_end(k)
+            self._dirty = True
+            self.hits += 1
+        try:
+            return np.memmap(self._file(k), dtype=np.int16, mode="r")
+        except (OSError, ValueError):
+            # файл удалили снаружи — считаем промахом
+            with self._lock:
+                self._bytes -= self._items.pop(k, 0)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, k: str, pcm: np.ndarray) -> None:
+        data = np.ascontiguousarray(pcm, dtype=np.int16)
+        if data.nbytes == 0 or data.nbytes > self.max_bytes:
+            return
+        try:
+            tmp = self._file(k) + ".tmp"
+            data.tofile(tmp)
+            os.replace(tmp, self._file(k))
+        except OSError as e:
+            print("TTS cache write error:", e)
+            return
+
+        with self._lock:
+            self._bytes += data.nbytes - self._items.pop(k, 0)
+            self._items[k] = data.nbytes
+            evicted = []
+            while self._bytes > self.max_bytes and self._items:
+                old, size = self._items.popitem(last=False)
+                self._bytes -= size
+                evicted.append(old)
+            self._dirty = True
+
+        for old in evicted:
+            try:
+                os.remove(self._file(old))
+            except OSError:
+                # на Windows файл может быть ещё открыт memmap'ом — уберёт _load
+                pass
+        self.save()
+
+    def close(self) -> None:
+        """Сохраняет порядок LRU после попаданий (вызывать при выходе)."""
+        self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "phrases": len(self._items),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+    def _load(self) -> None:
+        known = set()
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, encoding="utf-8") as f:
+                    entries = json.load(f)
+                # в index.json — от давних к свежим
+                for k, size in entries:
+                    if os.path.exists(self._file(k)):
+                        self._items[k] = int(size)
+                        self._bytes += int(size)
+                        known.add(k)
+            except Exception as e:
+                print("TTS cache index load error:", e)
+
+        # файлы без записи в индексе (упали между записью и save) — мусор
+        for name in os.listdir(self.path):
+            if name.endswith((".pcm", ".tmp")) and name.split(".")[0] not in known:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = list(self._items.items())
+            self._dirty = False
+        try:
+            tmp = self._index_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self._index_path)
+        except Exception as e:
+            print("TTS cache index save error:", e)
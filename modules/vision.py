@@ -1,39 +1,114 @@
 import mss
 import base64
 import io
+import platform
+import time
 import requests
 from PIL import Image
-from config import OLLAMA_URL, VISION_MODEL
+from config import (
+    VISION_MODEL,
+    VISION_CAPTURE,
+    VISION_REGION,
+    VISION_MAX_SIDE,
+    VISION_IMAGE_FORMAT,
+    VISION_JPEG_QUALITY,
+    VISION_DEBUG,
+)
+from modules import tracing
+from modules.ollama_client import build_payload, generate, stream_generate
 
 
+def _active_window_rect() -> dict | None:
+    """
+    Прямоугольник активного окна (только Windows). None — не удалось.
+    """
+    if platform.system() != "Windows":
+        return None
+
+    import ctypes
+    from ctypes import wintypes
+
+    user32 = ctypes.windll.user32
+    hwnd = user32.GetForegroundWindow()
+    if not hwnd:
+        return None
+
+    rect = wintypes.RECT()
+    if not user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+        return None
+
+    width = rect.right - rect.left
+    height = rect.bottom - rect.top
+    if width <= 0 or height <= 0:
+        return None
+    return {"left": rect.left, "top": rect.top, "width": width, "height": height}
+
+
+def _capture_area(sct) -> dict:
+    if VISION_CAPTURE == "region" and VISION_REGION:
+        left, top, width, height = VISION_REGION
+        return {"left": left, "top": top, "width": width, "height": height}
+
+    if VISION_CAPTURE == "window":
+        rect = _active_window_rect()
+        if rect is not None:
+            return rect
+
+    return sct.monitors[1]
+
+
+@tracing.traced("vision.capture")
 def capture_screen():
+    """
+    Снимок экрана/окна/области -> base64 картинки для Ollama.
+    Кадр сразу уменьшается до VISION_MAX_SIDE (llava всё равно ресайзит сама)
+    и жмётся в JPEG — это в разы меньше работы и трафика, чем PNG полного экрана.
+    """
+    timings = {}
+    t0 = time.perf_counter()
+
     with mss.mss() as sct:
-        monitor = sct.monitors[1]
-        shot = sct.grab(monitor)
+        shot = sct.grab(_capture_area(sct))
+        t1 = time.perf_counter()
+        timings["grab"] = t1 - t0
+
+        # читаем BGRA-буфер mss напрямую, без промежуточного shot.rgb
+        img = Image.frombuffer("RGB", shot.size, shot.bgra, "raw", "BGRX", 0, 1)
+
+        scale = VISION_MAX_SIDE / max(img.size)
+        if scale < 1:
+            new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            # reducing_gap: сначала быстрый целочисленный reduce (box), потом bilinear
+            img = img.resize(new_size, Image.Resampling.BILINEAR, reducing_gap=1.0)
+        t2 = time.perf_counter()
+        timings["resize"] = t2 - t1
+
+    buffer = io.BytesIO()
+    if VISION_IMAGE_FORMAT.upper() == "PNG":
+        img.save(buffer, format="PNG", compress_level=1)
+    else:
+        img.save(buffer, format="JPEG", quality=VISION_JPEG_QUALITY)
+    t3 = time.perf_counter()
+    timings["encode"] = t3 - t2
 
-        img = Image.frombytes("RGB", shot.size, shot.rgb)
+    data = base64.b64encode(buffer.getbuffer()).decode()
+    timings["base64"] = time.perf_counter() - t3
 
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
+    if VISION_DEBUG:
+        stages = " ".join(f"{k}={v * 1000:.1f}ms" for k, v in timings.items())
+        print(f"Vision capture {img.width}x{img.height} {len(data) // 1024} KB: {stages}")
 
-        return base64.b64encode(buffer.getvalue()).decode()
+    return data
 
 
-def ask_vision(prompt: str) -> str:
+@tracing.traced("vision.generate")
+def ask_vision(prompt: str, options: dict | None = None) -> str:
     try:
         image = capture_screen()
 
-        payload = {
-            "model": VISION_MODEL,
-            "prompt": prompt,
-            "images": [image],
-            "stream": False
-        }
+        payload = build_payload(VISION_MODEL, prompt, options, images=[image])
 
-        r = requests.post(OLLAMA_URL, json=payload, timeout=120)
-        r.raise_for_status()
-
-        data = r.json()
+        data = generate(payload)
 
         if "response" not in data:
             print("Vision raw response:", data)
@@ -48,4 +123,26 @@ def ask_vision(prompt: str) -> str:
         return "Ошибка: Vision модель слишком долго отвечает."
 
     except Exception as e:
-        return f"Vision error: {repr(e)}"
\ No newline at end of file
+        return f"Vision error: {repr(e)}"
+
+
+def ask_vision_stream(prompt: str, options: dict | None = None, cancel=None):
+    """
+    Потоковый вариант ask_vision: снимает экран и отдаёт токены по мере генерации.
+    cancel (threading.Event) обрывает стрим на стороне Ollama.
+    """
+    try:
+        image = capture_screen()
+
+        payload = build_payload(VISION_MODEL, prompt, options, images=[image])
+
+        yield from stream_generate(payload, cancel=cancel)
+
+    except requests.exceptions.ConnectionError:
+        yield "Ошибка: Ollama не запущена."
+
+    except requests.exceptions.Timeout:
+        yield "Ошибка: Vision модель слишком долго отвечает."
+
+    except Exception as e:
+        yield f"Vision error: {repr(e)}"